@@ -0,0 +1,256 @@
+"""
+Wall time and peak memory of replicate.py and the analysis scripts, stage by stage.
+
+Synthetic supercells are built from the bundled Fe6C2 POSCAR at the requested
+sizes, and synthetic OSZICAR/CONTCAR/OUTCAR trees with the requested number of
+runs are written to a temporary directory. Every stage is timed (best of
+--repeat) and run once more under tracemalloc for its peak traced memory.
+The results are written as JSON, and --baseline compares them with an earlier run:
+
+    python benchmarks/bench_suite.py --sizes 1e2 1e4 1e6 --runs 2000 -o after.json --baseline before.json
+
+Use --stages to run a subset, e.g. for a single large size:
+
+    python benchmarks/bench_suite.py --sizes 1e7 --stages replication write_poscar poscar_read neighbor_shells
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, List, Optional
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(ROOT, 'moveVASPfiles'))
+sys.path.insert(0, os.path.join(ROOT, 'result_analysis'))
+sys.path.insert(0, ROOT)
+from profile_module import max_rss_mib
+from replicate import System, replicate_poscar, write_poscar
+
+CELL_STAGES = ['replication', 'write_poscar', 'poscar_read', 'neighbor_shells', 'partial_rdf', 'replicate_poscar']
+RUN_STAGES = ['analyze_directory', 'analyze_directory_cached', 'analyze_convergence', 'check_directories', 'collect']
+
+DEFAULT_SIZES = [1e2, 1e3, 1e4, 1e5, 1e6]
+
+
+def measure(func: Callable[[], object], repeat: int = 3, memory: bool = True) -> dict:
+    """Best wall time of `repeat` calls, then the peak traced memory of one more call."""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+    return {'seconds': best, 'peak_mib': peak, 'max_rss_mib': max_rss_mib()}
+
+
+def supercell_multipliers(natoms_cell: int, natoms: int) -> List[int]:
+    # Near-cubic multipliers whose supercell has at most `natoms` atoms (at least one cell)
+    n = max(1, int(np.floor((natoms / natoms_cell) ** (1.0 / 3.0) + 1e-9)))
+    mults = [n, n, n]
+    for axis in range(3):
+        if (mults[axis] + 1) * np.prod(mults) // mults[axis] * natoms_cell <= natoms:
+            mults[axis] += 1
+    return mults
+
+
+def synthetic_runs(directory: str, poscar_file: str, nruns: int, ionic_steps: int = 5, seed: int = 0) -> None:
+    """Write OSZICAR_n/CONTCAR_n pairs, input_n folders and OUTCAR_n files for nruns runs.
+
+    Lattices are scaled randomly around the POSCAR, and every OUTCAR holds
+    `ionic_steps` stress lines, force blocks and magnetization blocks, as a
+    relaxation would. Half of the positions have a negative x, as in hexagonal cells.
+    """
+    rng = np.random.default_rng(seed)
+    with open(poscar_file) as f:
+        lines = f.readlines()
+    lattice = np.array([line.split()[:3] for line in lines[2:5]], dtype=float)
+    natoms = int(np.sum(np.array(lines[6].split(), dtype=int)))
+    os.makedirs(directory, exist_ok=True)
+
+    for n in range(1, nruns + 1):
+        strain = 1.0 + 0.03 * rng.standard_normal()
+        cell = ''.join('  ' + ' '.join(f'{value:20.16f}' for value in row) + '\n' for row in lattice * strain)
+        contcar = ''.join(lines[:2]) + cell + ''.join(lines[5:])
+
+        energies = -8.0 * natoms + 0.5 * rng.standard_normal(ionic_steps).cumsum()
+        mag = 2.2 * natoms + rng.standard_normal(ionic_steps)
+        oszicar = ['       N       E                     dE             d eps       ncg     rms          rms(c)\n']
+        for step in range(ionic_steps):
+            oszicar.append(f'DAV:   1    {energies[step]:.8E}   -0.2E+03   -0.2E+04  4384   0.3E+03\n')
+            oszicar.append(f'{step + 1:4d} F= {energies[step]:.8E} E0= {energies[step]:.8E}  '
+                           f'd E ={-0.01:.8E}  mag= {mag[step]:10.4f}\n')
+
+        outcar = [f' running on 1 nodes\n   number of dos      NEDOS =    301   number of ions     NIONS = {natoms:6d}\n']
+        for step in range(ionic_steps):
+            moments = 2.2 + 0.3 * rng.standard_normal(natoms)
+            stress = rng.standard_normal(6) * 10.0 / (step + 1)
+            forces = rng.standard_normal((natoms, 3)) * 0.5 / (step + 1) ** 2
+            outcar.append('  in kB   ' + ''.join(f'{value:12.5f}' for value in stress) + '\n'
+                          f'  external pressure = {stress[:3].mean():11.2f} kB  Pullay stress =        0.00 kB\n\n'
+                          ' POSITION                                       TOTAL-FORCE (eV/Angst)\n'
+                          ' ' + '-' * 83 + '\n')
+            outcar.extend(f'  {(i - natoms // 2) * 0.5:11.5f}  {i * 0.25:11.5f}  {0.0:11.5f}  {f[0]:13.6f} {f[1]:13.6f} {f[2]:13.6f}\n'
+                          for i, f in enumerate(forces))
+            outcar.append(' ' + '-' * 83 + '\n    total drift:                                0.000000      0.000000      0.000000\n\n')
+            outcar.append(' magnetization (x)\n\n# of ion       s       p       d       tot\n'
+                          '------------------------------------------\n')
+            outcar.extend(f'{i + 1:5d}       -0.012  -0.045  {m:6.3f}  {m:6.3f}\n' for i, m in enumerate(moments))
+            outcar.append('--------------------------------------------------\n'
+                          f'tot          -0.1   -0.4    {moments.sum():.1f}    {moments.sum():.1f}\n\n')
+
+        input_dir = os.path.join(directory, f'input_{n}')
+        os.makedirs(input_dir, exist_ok=True)
+        for path, text in ((os.path.join(directory, f'CONTCAR_{n}'), contcar),
+                           (os.path.join(directory, f'OSZICAR_{n}'), ''.join(oszicar)),
+                           (os.path.join(directory, f'OUTCAR_{n}'), ''.join(outcar)),
+                           (os.path.join(input_dir, 'CONTCAR'), contcar),
+                           (os.path.join(input_dir, 'OSZICAR'), ''.join(oszicar))):
+            with open(path, 'w') as f:
+                f.write(text)
+
+
+def bench_cells(parent: System, sizes: List[int], stages: List[str], workdir: str, cutoff: float,
+                repeat: int, memory: bool) -> List[dict]:
+    records = []
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        for size in sizes:
+            mults = supercell_multipliers(parent.atoms.natoms, size)
+            natoms = parent.atoms.natoms * int(np.prod(mults))
+            supercell = parent.replication(*mults)
+            poscar_file = os.path.join(workdir, f'POSCAR_{natoms}')
+            write_poscar(supercell, poscar_file)
+
+            stage_funcs = {
+                'replication': lambda: parent.replication(*mults),
+                'write_poscar': lambda: write_poscar(supercell, poscar_file),
+                'poscar_read': lambda: System.poscar_read(poscar_file),
+                'neighbor_shells': lambda: supercell.neighbor_shells(cutoff),
+                'partial_rdf': lambda: supercell.partial_rdf(cutoff),
+                'replicate_poscar': lambda: replicate_poscar(parent, *mults, 'replicated_POSCAR', 10,
+                                                             cutoff=cutoff, plot=False),
+            }
+            for stage in stages:
+                if stage in stage_funcs:
+                    record = {'stage': stage, 'size': natoms, 'mults': mults}
+                    record.update(measure(stage_funcs[stage], repeat, memory))
+                    records.append(record)
+                    report(record)
+            del supercell
+            os.remove(poscar_file)
+    finally:
+        os.chdir(cwd)
+    return records
+
+
+def bench_runs(poscar_file: str, nruns: int, stages: List[str], workdir: str, workers: Optional[int],
+               repeat: int, memory: bool) -> List[dict]:
+    from check_permag import check_directories
+    from convergence_analysis import analyze_convergence
+    from copy_files import collect
+    from simulation_analysis import analyze_directory
+
+    directory = os.path.join(workdir, 'runs')
+    synthetic_runs(directory, poscar_file, nruns)
+    analyze_directory(directory, workers=workers)
+    # A position line with a negative x must not end its force block
+    if np.isnan(analyze_convergence(directory, workers=workers)['max_force']).any():
+        raise RuntimeError(f'{directory}: force blocks of the synthetic OUTCARs were not parsed')
+
+    def collect_fresh():
+        destination = tempfile.mkdtemp(dir=workdir)
+        collect(directory, destination, workers=workers)
+        shutil.rmtree(destination)
+
+    stage_funcs = {
+        'analyze_directory': lambda: analyze_directory(directory, workers=workers, use_cache=False),
+        'analyze_directory_cached': lambda: analyze_directory(directory, workers=workers),
+        'analyze_convergence': lambda: analyze_convergence(directory, workers=workers),
+        'check_directories': lambda: check_directories([directory], workers=workers),
+        'collect': collect_fresh,
+    }
+    records = []
+    for stage in stages:
+        if stage in stage_funcs:
+            record = {'stage': stage, 'size': nruns}
+            record.update(measure(stage_funcs[stage], repeat, memory))
+            records.append(record)
+            report(record)
+    return records
+
+
+def report(record: dict, baseline: Optional[dict] = None) -> None:
+    peak = '-' if record['peak_mib'] is None else f"{record['peak_mib']:.1f}"
+    line = f"{record['stage']:>26} {record['size']:>10d} {record['seconds']:10.4f} s {peak:>10} MiB"
+    if baseline is not None:
+        line += f"   {record['seconds'] / baseline['seconds']:6.2f}x time"
+        if record['peak_mib'] is not None and baseline.get('peak_mib'):
+            line += f"   {record['peak_mib'] / baseline['peak_mib']:6.2f}x memory"
+    print(line, flush=True)
+
+
+def compare(records: List[dict], baseline_file: str) -> None:
+    # Ratios of this run to an earlier one, for the stages and sizes both contain
+    with open(baseline_file) as f:
+        baseline = {(row['stage'], row['size']): row for row in json.load(f)['results']}
+    print(f'\nCompared with {baseline_file}:')
+    for record in records:
+        if (record['stage'], record['size']) in baseline:
+            report(record, baseline[(record['stage'], record['size'])])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark replicate.py and the analysis scripts')
+    parser.add_argument('--poscar', default=os.path.join(ROOT, 'POSCAR'), help='unit cell to replicate')
+    parser.add_argument('--sizes', type=float, nargs='+', default=DEFAULT_SIZES,
+                        help='approximate supercell sizes in atoms (default: 1e2 to 1e6)')
+    parser.add_argument('--runs', type=int, default=2000, help='number of synthetic runs in the analysis tree')
+    parser.add_argument('--stages', nargs='+', default=CELL_STAGES + RUN_STAGES,
+                        choices=CELL_STAGES + RUN_STAGES, help='stages to run')
+    parser.add_argument('--cutoff', type=float, default=3.0, help='neighbor and RDF cutoff in angstrom')
+    parser.add_argument('--repeat', type=int, default=3, help='timed calls per stage (the best is kept)')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='workers of the analysis scripts')
+    parser.add_argument('--no-memory', action='store_true', help='skip the traced memory measurement')
+    parser.add_argument('-o', '--output', default='bench_results.json', help='JSON results file')
+    parser.add_argument('--baseline', default=None, help='earlier JSON results file to compare with')
+    args = parser.parse_args()
+
+    parent = System.poscar_read(args.poscar)
+    records = []
+    with tempfile.TemporaryDirectory() as workdir:
+        records += bench_cells(parent, [int(size) for size in args.sizes], args.stages, workdir,
+                               args.cutoff, args.repeat, not args.no_memory)
+        if any(stage in RUN_STAGES for stage in args.stages):
+            records += bench_runs(args.poscar, args.runs, args.stages, workdir, args.workers,
+                                  args.repeat, not args.no_memory)
+
+    meta = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'repeat': args.repeat,
+            'cutoff': args.cutoff}
+    with open(args.output, 'w') as f:
+        json.dump({'meta': meta, 'results': records}, f, indent=1)
+    print(f'Results have been written to {args.output}.')
+
+    if args.baseline:
+        compare(records, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,73 +1,163 @@
+import argparse
+import csv
+import json
+import mmap
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from profile_module import add_counts, add_profile_argument, pool_map, report, stage
+
+FILE_EXTENSIONS = ['OUTCAR', 'INCAR', 'CONTCAR', 'OSZICAR']
+
+REPORT_FIELDS = ['directory', 'outcar', 'natoms', 'min_mag', 'max_mag', 'mean_mag', 'passed']
+
+
+def _number_of_ions(buffer) -> Optional[int]:
+    # NIONS is printed once, in the header
+    start = buffer.find(b'NIONS =')
+    if start < 0:
+        return None
+    end = buffer.find(b'\n', start)
+    return int(buffer[start + len(b'NIONS ='):end].split()[0])
+
 
 def get_number_of_ions(file_path):
-    with open(file_path, 'r') as file:
-        for line in file:
-            if 'NIONS =' in line:
-                number_of_ions = line.split('=')[2].strip()
-                return number_of_ions
-
-    return None
-
-def track_strings_in_file(file_path, lines2read):
-    found_string1 = False
-    lines_to_skip = 4
-    lines_to_read = lines2read
-    lines = []
-
-    with open(file_path, 'r') as file:
-        for line in file:
-            if 'magnetization (x)' in line:
-                found_string1 = True
-                lines = []
-                
-            if found_string1:
-                if lines_to_skip > 0:
-                    lines_to_skip -= 1
-                elif lines_to_read > 0:
-                    lines.append(line.strip())
-                    lines_to_read -= 1
-
-            if lines_to_read == 0:
-                break
-
-    return lines
-
-
-directory = './'
-file_extensions = ['OUTCAR', 'INCAR', 'CONTCAR', 'OSZICAR']
-backup_dir = os.path.join(directory, 'backup')
-
-# Create backup directory if it doesn't exist
-if not os.path.exists(backup_dir):
-    os.makedirs(backup_dir)
-
-# Set the current working directory
-os.chdir(directory)
-
-# per atom magnetic cutoff
-magcutoff = 2.0
-
-for filename in os.listdir(directory):
-    if filename.startswith('OUTCAR'):
-        outcar_filepath = os.path.join(directory, filename)
-        trailing_number = filename.split('_')[-1]
-        lines2read = int(get_number_of_ions(outcar_filepath))
-        lines_between_strings = track_strings_in_file(outcar_filepath, lines2read)
-        # print(lines_between_strings)
-        if lines_between_strings:
-            elements = [line.split()[-1] for line in lines_between_strings]
-            if any(float(i) < magcutoff for i in elements):
-                # print(elements)
-                for extension in file_extensions:
-                    matching_file = f'{extension}_{trailing_number}'
-                    matching_filepath = os.path.join(directory, matching_file)
-                    if os.path.isfile(matching_filepath):
-                        os.rename(matching_filepath, os.path.join(backup_dir, matching_file))
-
-                if os.path.isfile(outcar_filepath):
-                    os.rename(outcar_filepath, os.path.join(backup_dir, filename))
-            else:
-                print("All values in 'elements' are greater than or equal to the cutoff.")
-                break
+    with open(file_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return _number_of_ions(buffer)
+
+
+def read_magnetization(file_path) -> Optional[np.ndarray]:
+    """Per-atom total moments of the last complete 'magnetization (x)' block of an OUTCAR.
+
+    The file is memory-mapped and searched backwards from the end, so only the
+    header and the tail of a multi-GB OUTCAR are actually read.
+    """
+    with open(file_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            add_counts(bytes_mapped=len(buffer))
+            nions = _number_of_ions(buffer)
+            if nions is None:
+                return None
+
+            end = len(buffer)
+            while True:
+                start = buffer.rfind(b'magnetization (x)', 0, end)
+                if start < 0:
+                    return None
+
+                # Skip the title, the blank line, the column header and the rule
+                first = start
+                for _ in range(4):
+                    first = buffer.find(b'\n', first) + 1
+                last = first
+                for _ in range(nions):
+                    last = buffer.find(b'\n', last) + 1
+                    if last == 0:
+                        break
+
+                # A block cut short by a running job falls back to the previous one
+                if last > 0:
+                    try:
+                        table = np.array(buffer[first:last].split(), dtype=float).reshape(nions, -1)
+                        if table.shape[1] >= 2:
+                            return table[:, -1]
+                    except ValueError:
+                        pass
+                end = start
+
+
+def move_to_backup(directory: str, filename: str, backup_dir: Optional[str] = None) -> None:
+    # Move the OUTCAR and its matching INCAR/CONTCAR/OSZICAR (same suffix) to backup/
+    backup_dir = backup_dir or os.path.join(directory, 'backup')
+    os.makedirs(backup_dir, exist_ok=True)
+    suffix = filename[len('OUTCAR'):]
+    for extension in FILE_EXTENSIONS:
+        matching_file = f'{extension}{suffix}'
+        matching_filepath = os.path.join(directory, matching_file)
+        if os.path.isfile(matching_filepath):
+            os.rename(matching_filepath, os.path.join(backup_dir, matching_file))
+
+
+def evaluate_outcar(outcar_filepath: str, magcutoff: float, backup: bool = False) -> dict:
+    with stage('read_magnetization', files=1):
+        moments = read_magnetization(outcar_filepath)
+    directory, filename = os.path.split(outcar_filepath)
+    row = {'directory': directory, 'outcar': filename, 'natoms': 0, 'min_mag': None,
+           'max_mag': None, 'mean_mag': None, 'passed': None}
+    if moments is not None and len(moments):
+        passed = bool(np.all(moments >= magcutoff))
+        row.update(natoms=len(moments), min_mag=float(moments.min()), max_mag=float(moments.max()),
+                   mean_mag=float(moments.mean()), passed=passed)
+        if backup and not passed:
+            move_to_backup(directory, filename)
+    return row
+
+
+def find_outcars(directories: List[str]) -> List[str]:
+    paths = []
+    for directory in directories:
+        for filename in sorted(os.listdir(directory)):
+            path = os.path.join(directory, filename)
+            if filename.startswith('OUTCAR') and os.path.isfile(path):
+                paths.append(path)
+    return paths
+
+
+def check_directories(directories: List[str], magcutoff: float = 2.0, workers: Optional[int] = None,
+                      backup: bool = False) -> List[dict]:
+    """Apply the per-atom magnetic cutoff to every OUTCAR in the given run directories.
+
+    Files are scanned concurrently on a thread pool since the work is I/O-bound.
+    With backup=True the failing runs are moved to a backup/ folder in their directory.
+    """
+    with stage('find_outcars'):
+        paths = find_outcars(directories)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return pool_map(pool, lambda path: evaluate_outcar(path, magcutoff, backup), paths,
+                        name='check_directories.pool')
+
+
+def write_report(rows: List[dict], report_file: str) -> None:
+    if report_file.endswith('.json'):
+        with open(report_file, 'w') as f:
+            json.dump(rows, f, indent=1)
+    else:
+        with open(report_file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check per-atom magnetic moments of VASP runs')
+    parser.add_argument('directories', nargs='*', default=['./'], help='run directories to scan')
+    parser.add_argument('-c', '--cutoff', type=float, default=2.0, help='per atom magnetic cutoff')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of scanning threads')
+    parser.add_argument('-r', '--report', default=None, help='write a CSV or JSON (.json) report')
+    parser.add_argument('--backup', action='store_true',
+                        help='move runs below the cutoff to a backup folder (default: dry run)')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
+    rows = check_directories(args.directories, args.cutoff, workers=args.workers, backup=args.backup)
+    if args.report:
+        write_report(rows, args.report)
+
+    failed = sum(row['passed'] is False for row in rows)
+    missing = sum(row['passed'] is None for row in rows)
+    print(f'{len(rows)} OUTCAR files checked: {len(rows) - failed - missing} at or above the cutoff, '
+          f'{failed} below{" (moved to backup)" if args.backup else ""}, {missing} without magnetization.')
+    report()
+
 
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,125 @@
+import argparse
 import os
 import shutil
+import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 
-# Specify the source directory containing the input folders
-source_directory = './'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from profile_module import add_counts, add_profile_argument, pool_map, report, stage, timed
 
-# Prompt the user to enter the destination directory
-destination_directory = input("Enter the destination directory: ")
+# Files collected from every input_* folder by default
+DEFAULT_FILES = ['CONTCAR', 'OSZICAR']
 
-# Get a list of all folders in the source directory
-folders = [folder for folder in os.listdir(source_directory) if os.path.isdir(os.path.join(source_directory, folder)) and folder.startswith('input_')]
+MODES = ['copy', 'hardlink', 'reflink']
 
-# Iterate through each folder
-for folder in folders:
-    # Get the folder number by removing the 'input_' prefix
-    folder_number = folder.replace('input_', '')
+# ioctl request that clones a file's extents (Linux, btrfs/XFS and similar)
+FICLONE = 0x40049409
 
-    # Create the source file paths
-    contcar_source = os.path.join(source_directory, folder, 'CONTCAR')
-    oszicar_source = os.path.join(source_directory, folder, 'OSZICAR')
 
-    # Create the destination file paths with the folder number prefix
-    contcar_destination = os.path.join(destination_directory, f'CONTCAR_{folder_number}')
-    oszicar_destination = os.path.join(destination_directory, f'OSZICAR_{folder_number}')
+def find_input_folders(source_directory: str) -> List[str]:
+    # Get a list of all input_* folders in the source directory
+    return sorted(entry.name for entry in os.scandir(source_directory)
+                  if entry.is_dir() and entry.name.startswith('input_'))
 
-    # Rename and move the files
-    shutil.copyfile(contcar_source, contcar_destination)
-    shutil.copyfile(oszicar_source, oszicar_destination)
 
-print('Files renamed and moved successfully.')
+def _up_to_date(source_stat: os.stat_result, destination: str) -> bool:
+    try:
+        destination_stat = os.stat(destination)
+    except FileNotFoundError:
+        return False
+    if (destination_stat.st_dev, destination_stat.st_ino) == (source_stat.st_dev, source_stat.st_ino):
+        return True
+    return (destination_stat.st_size == source_stat.st_size
+            and destination_stat.st_mtime_ns == source_stat.st_mtime_ns)
+
+
+def _reflink(source: str, destination: str) -> bool:
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        if os.path.exists(destination):
+            os.remove(destination)
+        return False
+    shutil.copystat(source, destination)
+    return True
+
+
+@timed('collect_file')
+def collect_file(source: str, destination: str, mode: str = 'copy') -> str:
+    """Copy, hard-link or reflink one file, returning what was done."""
+    try:
+        source_stat = os.stat(source)
+    except FileNotFoundError:
+        return 'missing'
+    if _up_to_date(source_stat, destination):
+        return 'skipped'
+
+    if mode != 'copy' and os.path.lexists(destination):
+        os.remove(destination)
+    same_filesystem = source_stat.st_dev == os.stat(os.path.dirname(destination) or '.').st_dev
+    if mode == 'hardlink' and same_filesystem:
+        os.link(source, destination)
+        return 'linked'
+    if mode == 'reflink' and same_filesystem and _reflink(source, destination):
+        return 'reflinked'
+
+    # copy2 keeps the modification time, so unchanged files are skipped next time
+    shutil.copy2(source, destination)
+    add_counts(bytes_copied=source_stat.st_size)
+    return 'copied'
+
+
+def collect(source_directory: str, destination_directory: str, filenames: Optional[List[str]] = None,
+            mode: str = 'copy', workers: Optional[int] = None) -> Counter:
+    """Collect `filenames` from every input_<n> folder as <file>_<n> in the destination.
+
+    Files are transferred on a thread pool. Destinations whose size and mtime
+    already match the source are skipped. With mode 'hardlink' or 'reflink' the
+    files are linked instead of copied when both sides share a filesystem.
+    """
+    if mode not in MODES:
+        raise ValueError(f'Unknown collection mode: {mode}')
+    filenames = filenames or DEFAULT_FILES
+    os.makedirs(destination_directory, exist_ok=True)
+
+    jobs = []
+    with stage('find_input_folders'):
+        folders = find_input_folders(source_directory)
+    for folder in folders:
+        # Get the folder number by removing the 'input_' prefix
+        folder_number = folder.replace('input_', '')
+        for filename in filenames:
+            jobs.append((os.path.join(source_directory, folder, filename),
+                         os.path.join(destination_directory, f'{filename}_{folder_number}')))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return Counter(pool_map(pool, lambda job: collect_file(*job, mode=mode), jobs,
+                                name='collect.pool'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collect files from input_* folders into one directory')
+    parser.add_argument('destination', help='destination directory')
+    parser.add_argument('-s', '--source', default='./', help='directory containing the input_* folders')
+    parser.add_argument('-f', '--files', nargs='+', default=DEFAULT_FILES,
+                        help=f'files to collect (default: {" ".join(DEFAULT_FILES)})')
+    parser.add_argument('-m', '--mode', choices=MODES, default='copy',
+                        help='copy, or link when source and destination share a filesystem')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of transfer threads')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
+    counts = collect(args.source, args.destination, args.files, mode=args.mode, workers=args.workers)
+    print('Files collected: ' + ', '.join(f'{count} {status}' for status, count in sorted(counts.items())))
+    report()
+
+
+if __name__ == '__main__':
+    main()
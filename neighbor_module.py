@@ -0,0 +1,258 @@
+from __future__ import annotations
+from typing import Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+
+
+# Upper bound on the number of candidate pairs held in memory at once
+MAX_PAIRS = 2_000_000
+
+
+def cell_list_pairs(centers: np.ndarray, points: np.ndarray, cutoff: Optional[float] = None,
+                    self_index: Optional[np.ndarray] = None,
+                    max_pairs: int = MAX_PAIRS) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Yield (center index, point index, distance) chunks for pairs within cutoff.
+
+    The points are binned on a linked-cell grid with a bin edge of at least
+    `cutoff`, so only the 27 surrounding bins are searched for each center.
+    Without a cutoff every pair is returned, streamed in bounded chunks.
+    `self_index[i]` is the point matching center i, which is skipped.
+    """
+    centers = np.asarray(centers, dtype=float)
+    points = np.asarray(points, dtype=float)
+    if len(centers) == 0 or len(points) == 0:
+        return
+
+    lo = np.minimum(centers.min(axis=0), points.min(axis=0))
+    hi = np.maximum(centers.max(axis=0), points.max(axis=0))
+    extent = hi - lo
+    if cutoff is None:
+        size = extent.max() + 1.0
+    else:
+        # Keep the grid at no more bins than points
+        density_edge = np.cbrt(np.prod(np.maximum(extent, 1e-8)) / len(points))
+        size = max(float(cutoff), density_edge)
+    ncell = np.maximum(np.floor(extent / size).astype(np.int64) + 1, 1)
+
+    def bin_of(xyz):
+        b = np.floor((xyz - lo) / size).astype(np.int64)
+        return np.minimum(b, ncell - 1)
+
+    pbin = bin_of(points)
+    pflat = (pbin[:, 0] * ncell[1] + pbin[:, 1]) * ncell[2] + pbin[:, 2]
+    order = np.argsort(pflat, kind='stable')
+    bin_counts = np.bincount(pflat, minlength=int(np.prod(ncell)))
+    bin_starts = np.cumsum(bin_counts) - bin_counts
+
+    cbin = bin_of(centers)
+    shifts = np.array([[i, j, k] for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)])
+    for shift in shifts:
+        target = cbin + shift
+        valid = np.all((target >= 0) & (target < ncell), axis=1)
+        if not valid.any():
+            continue
+        tflat = (target[:, 0] * ncell[1] + target[:, 1]) * ncell[2] + target[:, 2]
+        counts = np.where(valid, bin_counts[np.where(valid, tflat, 0)], 0)
+        starts = np.where(valid, bin_starts[np.where(valid, tflat, 0)], 0)
+        cum = np.cumsum(counts)
+        if cum[-1] == 0:
+            continue
+
+        begin = 0
+        while begin < len(centers):
+            base = cum[begin - 1] if begin else 0
+            end = max(begin + 1, int(np.searchsorted(cum, base + max_pairs, side='right')))
+            chunk_counts = counts[begin:end]
+            total = int(chunk_counts.sum())
+            if total:
+                ii = np.repeat(np.arange(begin, end), chunk_counts)
+                first = np.cumsum(chunk_counts) - chunk_counts
+                slot = np.arange(total) - np.repeat(first, chunk_counts)
+                jj = order[np.repeat(starts[begin:end], chunk_counts) + slot]
+
+                d = centers[ii] - points[jj]
+                dist = np.sqrt((d * d).sum(axis=-1))
+                keep = np.ones(total, dtype=bool) if cutoff is None else dist <= cutoff
+                if self_index is not None:
+                    keep &= jj != self_index[ii]
+                yield ii[keep], jj[keep], dist[keep]
+            begin = end
+
+
+def periodic_pairs(frac: np.ndarray, vects: np.ndarray, cutoff: float,
+                   max_pairs: int = MAX_PAIRS) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Yield (site, neighbor site, distance) chunks of a periodic cell within cutoff.
+
+    Neighbors are taken from the periodic images of the cell, so no supercell
+    has to be built. Of the shifted images only the atoms in a layer `cutoff`
+    thick around the cell are kept, so for cells larger than the cutoff the
+    search holds little more than the cell itself. Neighbor indices refer back
+    to the atoms of the cell.
+    """
+    vects = np.asarray(vects, dtype=float)
+    frac = np.mod(np.asarray(frac, dtype=float), 1.0)
+    natoms = len(frac)
+
+    # Number of images needed along each lattice vector to cover the cutoff,
+    # and the cutoff as a fraction of the spacing between lattice planes
+    volume = abs(np.linalg.det(vects))
+    spacing = volume / np.linalg.norm(np.cross(vects[[1, 2, 0]], vects[[2, 0, 1]]), axis=1)
+    margin = cutoff / spacing
+    n = np.ceil(margin).astype(int)
+    grid = np.stack(np.meshgrid(*[np.arange(-k, k + 1) for k in n], indexing='ij'), axis=-1).reshape(-1, 3)
+
+    # The cell itself comes first, so atom i is its own image i
+    points = [frac]
+    sites = [np.arange(natoms)]
+    for shift in grid[grid.any(axis=1)]:
+        shifted = frac + shift
+        layer = np.all((shifted >= -margin) & (shifted < 1.0 + margin), axis=1)
+        points.append(shifted[layer])
+        sites.append(np.flatnonzero(layer))
+    images = np.concatenate(points) @ vects
+    sites = np.concatenate(sites)
+
+    for ii, jj, dist in cell_list_pairs(frac @ vects, images, cutoff=cutoff, self_index=np.arange(natoms),
+                                        max_pairs=max_pairs):
+        yield ii, sites[jj], dist
+
+
+def supercell_pairs(frac: np.ndarray, vects: np.ndarray, mults: np.ndarray, cutoff: float,
+                    max_pairs: int = MAX_PAIRS) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
+    """Yield (site, neighbor site, distance, weight) chunks of a finite (non-periodic) supercell.
+
+    Only the parent cell is used. A pair of images separated by a lattice shift n
+    occurs prod(mults - |n|) times in the supercell, so the parent atoms are
+    searched against the shifted images once and every pair carries that weight.
+    """
+    vects = np.asarray(vects, dtype=float)
+    frac = np.asarray(frac, dtype=float)
+    mults = np.asarray(mults, dtype=int)
+    natoms = len(frac)
+
+    volume = abs(np.linalg.det(vects))
+    spacing = volume / np.linalg.norm(np.cross(vects[[1, 2, 0]], vects[[2, 0, 1]]), axis=1)
+    span = frac.max(axis=0) - frac.min(axis=0)
+    n = np.minimum(np.ceil(cutoff / spacing + span).astype(int), mults - 1)
+    grid = np.stack(np.meshgrid(*[np.arange(-k, k + 1) for k in n], indexing='ij'), axis=-1).reshape(-1, 3)
+
+    centers = frac @ vects
+    images = ((frac[np.newaxis] + grid[:, np.newaxis]) @ vects).reshape(-1, 3)
+    weights = np.repeat(np.prod(mults - np.abs(grid), axis=1), natoms)
+    zero_image = int(np.flatnonzero(~grid.any(axis=1))[0])
+    self_index = zero_image * natoms + np.arange(natoms)
+
+    for ii, jj, dist in cell_list_pairs(centers, images, cutoff=cutoff, self_index=self_index,
+                                        max_pairs=max_pairs):
+        yield ii, jj % natoms, dist, weights[jj]
+
+
+def _count_keys(key_chunks: Iterable) -> Tuple[np.ndarray, np.ndarray]:
+    # Chunks are key arrays, or (keys, weights) tuples for weighted counts
+    keys = np.empty(0, dtype=np.int64)
+    counts = np.empty(0, dtype=np.int64)
+    for chunk in key_chunks:
+        if isinstance(chunk, tuple):
+            chunk_keys, inverse = np.unique(chunk[0], return_inverse=True)
+            chunk_counts = np.bincount(inverse, weights=chunk[1], minlength=len(chunk_keys))
+        else:
+            chunk_keys, chunk_counts = np.unique(chunk, return_counts=True)
+        keys, inverse = np.unique(np.concatenate((keys, chunk_keys)), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate((counts, chunk_counts)),
+                             minlength=len(keys)).astype(np.int64)
+    return keys, counts
+
+
+class ShellTable:
+    """Neighbor shells: distance (n_shells,), ordered pair count (n_shells,) and the
+    same counts split by species pair (n_shells, n_species, n_species), where
+    pair_counts[k, a, b] counts neighbors of species b around atoms of species a."""
+
+    def __init__(self, distance: np.ndarray, count: np.ndarray, pair_counts: np.ndarray, symbols: Tuple[str]):
+        self.distance = distance
+        self.count = count
+        self.pair_counts = pair_counts
+        self.symbols = symbols
+
+    def species_pair(self, symbol_a: str, symbol_b: str) -> np.ndarray:
+        return self.pair_counts[:, self.symbols.index(symbol_a), self.symbols.index(symbol_b)]
+
+
+def shell_table(pair_chunks: Iterable[Tuple[np.ndarray, ...]], species: np.ndarray, symbols: Tuple[str],
+                decimals: int = 3) -> ShellTable:
+    """Accumulate (site, neighbor, distance[, weight]) chunks into a ShellTable.
+
+    `species` holds the index into `symbols` of every site.
+    """
+    factor = 10.0 ** decimals
+    nspecies = len(symbols)
+    npairs = nspecies * nspecies
+
+    def keys_of(chunk):
+        keys = (np.rint(chunk[2] * factor).astype(np.int64) * npairs
+                + species[chunk[0]].astype(np.int64) * nspecies + species[chunk[1]])
+        return keys if len(chunk) == 3 else (keys, chunk[3])
+
+    keys, counts = _count_keys(keys_of(chunk) for chunk in pair_chunks)
+    shells, inverse = np.unique(keys // npairs, return_inverse=True)
+    pair_counts = np.zeros((len(shells), npairs), dtype=np.int64)
+    np.add.at(pair_counts, (inverse, keys % npairs), counts)
+    pair_counts = pair_counts.reshape(len(shells), nspecies, nspecies)
+    return ShellTable(distance=shells / factor, count=pair_counts.sum(axis=(1, 2)),
+                      pair_counts=pair_counts, symbols=tuple(symbols))
+
+
+def site_shell_histogram(pair_chunks: Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray]],
+                         natoms: int, decimals: int = 3) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Accumulate neighbor shells separately for every site."""
+    factor = 10.0 ** decimals
+    keys, counts = _count_keys(np.rint(dist * factor).astype(np.int64) * natoms + ii
+                               for ii, _, dist in pair_chunks)
+    sites = keys % natoms
+    order = np.argsort(sites, kind='stable')
+    bounds = np.searchsorted(sites[order], np.arange(1, natoms))
+    distances = np.split((keys[order] // natoms) / factor, bounds)
+    return list(zip(distances, np.split(counts[order], bounds)))
+
+
+class PartialRDF:
+    """Partial radial distribution functions g[a, b] (n_species, n_species, n_bins) on
+    fixed-width bins with centers r, and the ordered pair counts behind them."""
+
+    def __init__(self, r: np.ndarray, g: np.ndarray, counts: np.ndarray, symbols: Tuple[str]):
+        self.r = r
+        self.g = g
+        self.counts = counts
+        self.symbols = symbols
+
+    def species_pair(self, symbol_a: str, symbol_b: str) -> np.ndarray:
+        return self.g[self.symbols.index(symbol_a), self.symbols.index(symbol_b)]
+
+
+def pair_histogram(pair_chunks: Iterable[Tuple[np.ndarray, ...]], species: np.ndarray, nspecies: int,
+                   rmax: float, dr: float) -> np.ndarray:
+    """Bin (site, neighbor, distance[, weight]) chunks into a (n_species, n_species, n_bins)
+    histogram of ordered pair counts, with bins of width dr up to rmax."""
+    nbins = int(np.ceil(rmax / dr - 1e-9))
+    hist = np.zeros(nspecies * nspecies * nbins, dtype=np.float64)
+    for chunk in pair_chunks:
+        bins = (chunk[2] / dr).astype(np.int64)
+        keep = bins < nbins
+        keys = (species[chunk[0][keep]].astype(np.int64) * nspecies + species[chunk[1][keep]]) * nbins + bins[keep]
+        weights = None if len(chunk) == 3 else chunk[3][keep]
+        hist += np.bincount(keys, weights=weights, minlength=len(hist))
+    return hist.reshape(nspecies, nspecies, nbins)
+
+
+def normalize_rdf(hist: np.ndarray, dr: float, volume: float, species_counts: np.ndarray,
+                  symbols: Tuple[str]) -> PartialRDF:
+    """g_ab(r) = V / (N_a N_b) * n_ab(r) / shell volume, with n_ab the ordered pair
+    counts of `pair_histogram`."""
+    nbins = hist.shape[-1]
+    edges = np.arange(nbins + 1) * dr
+    shell_volume = 4.0 / 3.0 * np.pi * np.diff(edges ** 3)
+    species_counts = np.asarray(species_counts, dtype=float)
+    density = np.outer(species_counts, species_counts) / volume
+    with np.errstate(divide='ignore', invalid='ignore'):
+        g = hist / (density[:, :, np.newaxis] * shell_volume)
+    g[~np.isfinite(g)] = 0.0
+    return PartialRDF(r=edges[:-1] + 0.5 * dr, g=g, counts=hist, symbols=tuple(symbols))
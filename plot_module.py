@@ -1,14 +1,40 @@
-import numpy as np
-import pandas as pd
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional, Sequence
+import matplotlib
+from profile_module import pool_map
+
+
+def use_headless_backend() -> None:
+    # Compute nodes have no display, so render to files with Agg instead of blocking or failing
+    if 'MPLBACKEND' in os.environ or sys.platform in ('win32', 'darwin'):
+        return
+    if not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
+        matplotlib.use('Agg')
+
+
+use_headless_backend()
+
 import matplotlib.pyplot as plt
 from matplotlib.ticker import AutoMinorLocator
 
+# Shared style, applied once per process rather than on every figure
+STYLE = {'font.family': 'Times New Roman', 'font.size': 20, 'font.weight': 'normal'}
+
+_style_applied = False
+
+
+def apply_style() -> None:
+    global _style_applied
+    if not _style_applied:
+        plt.rcParams.update(STYLE)
+        _style_applied = True
+
+
 def plot_function():
-    plt.rcParams["font.family"] = "Times New Roman"
-    font = {'family': 'Times New Roman', 'size': 20, 'weight': 'normal'}
-    plt.rc('font', **font)
+    apply_style()
     fig, ax = plt.subplots(facecolor='w', edgecolor='k', tight_layout=True)
-    plt.gca()
     ax.tick_params(direction='in', length=7.0, width=1.5)
     right_side = ax.spines["right"]
     right_side.set_visible(True)
@@ -21,17 +47,39 @@ def plot_function():
     ax.yaxis.set_minor_locator(AutoMinorLocator())
     ax.tick_params(which='minor', direction='in', length=4)
 
-    def adjust_lightness(color, amount=0.5):
-        import matplotlib.colors as mc
-        import colorsys
-        try:
-            c = mc.cnames[color]
-        except:
-            c = color
-        c = colorsys.rgb_to_hls(*mc.to_rgb(c))
-        return colorsys.hls_to_rgb(c[0], max(0, min(1, amount * c[1])), c[2])
-
     # Add your plotting code here
-    plt.subplots_adjust(top=0.9)
-    # plt.tight_layout()  # Automatically adjust plot layout
+    fig.subplots_adjust(top=0.9)
+    return fig, ax
+
+
+def adjust_lightness(color, amount=0.5):
+    import matplotlib.colors as mc
+    import colorsys
+    try:
+        c = mc.cnames[color]
+    except:
+        c = color
+    c = colorsys.rgb_to_hls(*mc.to_rgb(c))
+    return colorsys.hls_to_rgb(c[0], max(0, min(1, amount * c[1])), c[2])
+
+
+def save_figure(fig, filename: str, show: bool = False) -> None:
+    # Always close the figure so repeated runs do not accumulate memory
+    fig.savefig(filename, format=os.path.splitext(filename)[1][1:] or 'pdf')
+    if show and matplotlib.get_backend().lower() != 'agg':
+        plt.show()
+    plt.close(fig)
+
+
+def render_many(render: Callable, jobs: Sequence[tuple], workers: Optional[int] = None) -> None:
+    """Call render(*job) for every job, in a pool of worker processes.
 
+    `render` must be a module-level function so that it can be sent to the workers.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(jobs) < 2:
+        for job in jobs:
+            render(*job)
+        return
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+        pool_map(pool, render, *zip(*jobs), name='render.pool', workers=min(workers, len(jobs)))
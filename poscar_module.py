@@ -0,0 +1,75 @@
+from __future__ import annotations
+from itertools import islice
+from typing import Optional, Tuple
+import numpy as np
+
+
+class Poscar:
+    def __init__(self, comment: str, vects: np.ndarray, symbols: Tuple[str], counts: np.ndarray,
+                 pos: np.ndarray, selective: Optional[np.ndarray] = None):
+        self.comment = comment
+        self.vects = vects
+        self.symbols = symbols
+        self.counts = counts
+        self.pos = pos
+        self.selective = selective
+
+    @property
+    def natoms(self) -> int:
+        return int(self.counts.sum())
+
+    def species(self) -> np.ndarray:
+        return np.repeat(np.array(self.symbols), self.counts)
+
+
+def read_poscar(poscar_file: str) -> Poscar:
+    """Read a POSCAR/CONTCAR file, returning scaled lattice vectors and fractional positions.
+
+    Handles VASP 4 and 5 headers, one or three scale factors (a negative one
+    is the cell volume), selective dynamics and Direct or Cartesian blocks.
+    VASP 4 files take their species labels from the first words of the comment
+    line; a ValueError is raised when it has fewer words than species.
+    The coordinate block is parsed in a single vectorized call.
+    """
+    with open(poscar_file, 'r') as file:
+        comment = file.readline().rstrip('\n')
+        scale = np.array(file.readline().split()[:3], dtype=float)
+        lattice = np.array([file.readline().split()[:3] for _ in range(3)], dtype=float)
+
+        parts = file.readline().split()
+        if all(part.isdigit() for part in parts):
+            # VASP 4 files have no species line, fall back to the comment
+            counts = np.array(parts, dtype=int)
+            symbols = tuple(comment.split()[:len(counts)])
+            if len(symbols) != len(counts):
+                raise ValueError(f'{poscar_file}: VASP 4 file needs {len(counts)} species labels '
+                                 f'in its comment line, found {len(symbols)}')
+        else:
+            symbols = tuple(parts)
+            counts = np.array(file.readline().split(), dtype=int)
+
+        mode = file.readline().strip()
+        selective = mode[:1] in ('s', 'S')
+        if selective:
+            mode = file.readline().strip()
+        cartesian = mode[:1] in ('c', 'C', 'k', 'K')
+
+        natoms = int(counts.sum())
+        lines = list(islice(file, natoms))
+
+    if len(scale) == 1 and scale[0] < 0:
+        factor = np.cbrt(-scale[0] / abs(np.linalg.det(lattice)))
+    else:
+        factor = scale
+    vects = lattice * factor
+
+    block = np.loadtxt(lines, usecols=(0, 1, 2), comments=('#', '!'), ndmin=2)
+    if len(block) != natoms:
+        raise ValueError(f'{poscar_file}: expected {natoms} positions, found {len(block)}')
+    pos = np.linalg.solve(vects.T, (block * factor).T).T if cartesian else block
+
+    flags = None
+    if selective:
+        flags = np.loadtxt(lines, usecols=(3, 4, 5), dtype=str, comments=('#', '!'), ndmin=2) == 'T'
+
+    return Poscar(comment=comment, vects=vects, symbols=symbols, counts=counts, pos=pos, selective=flags)
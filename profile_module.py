@@ -0,0 +1,263 @@
+"""
+Opt-in stage timing for replicate.py and the analysis scripts.
+
+Profiling is enabled with the VASP_PROFILE environment variable, or the
+--profile option of the scripts:
+
+    VASP_PROFILE=1 python replicate.py                    # summary table on stderr
+    VASP_PROFILE=trace.json python replicate.py           # summary and a JSON trace
+    python simulation_analysis.py runs/ --profile trace.json
+
+Every stage records its wall time, its counters (atoms, bytes read, pairs...)
+and the peak RSS of the process when it ends. Pools run through `pool_map`
+(or `map_batches`) also report their utilization, and stages recorded inside worker processes
+are sent back to the parent. When profiling is off, `stage` returns a shared
+no-op context and `timed` adds a single flag check per call.
+"""
+
+import argparse
+import functools
+import itertools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from typing import Callable, List, Optional, Sequence
+
+ENV_VAR = 'VASP_PROFILE'
+
+# Fields every event has; all other fields are counters
+EVENT_FIELDS = ('name', 'start', 'seconds', 'pid', 'thread', 'max_rss_mib')
+
+_setting = os.environ.get(ENV_VAR, '')
+_enabled = _setting not in ('', '0')
+_trace_file = _setting if _enabled and _setting != '1' else None
+
+_events = []
+_lock = threading.Lock()
+_local = threading.local()
+_origin = time.perf_counter()
+
+
+def enable(trace_file: Optional[str] = None) -> None:
+    global _enabled, _trace_file
+    _enabled = True
+    _trace_file = trace_file
+    # Worker processes pick the setting up from the environment
+    os.environ[ENV_VAR] = trace_file or '1'
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+class _ProfileAction(argparse.Action):
+    # Enables profiling as soon as the option is parsed
+    def __call__(self, parser, namespace, values, option_string=None):
+        enable(values or None)
+        setattr(namespace, self.dest, values)
+
+
+def add_profile_argument(parser: argparse.ArgumentParser) -> None:
+    """Add the --profile [TRACE] option, which enables profiling when given."""
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='TRACE', action=_ProfileAction,
+                        help='print stage timings, and write them to a JSON TRACE file if given')
+
+
+def max_rss_mib(who: int = resource.RUSAGE_SELF) -> float:
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def _stack() -> list:
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _record(event: dict) -> None:
+    # Inside pool_map tasks, events are buffered and returned with the result
+    buffer = getattr(_local, 'buffer', None)
+    if buffer is not None:
+        buffer.append(event)
+    else:
+        with _lock:
+            _events.append(event)
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        return False
+
+    def __bool__(self) -> bool:
+        return False
+
+    def add(self, **counts) -> None:
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, name: str, counts: dict):
+        self.name = name
+        self.counts = counts
+
+    def __enter__(self):
+        _stack().append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        seconds = time.perf_counter() - self.start
+        _stack().pop()
+        event = {'name': self.name, 'start': self.start - _origin, 'seconds': seconds, 'pid': os.getpid(),
+                 'thread': threading.get_ident(), 'max_rss_mib': max_rss_mib()}
+        event.update(self.counts)
+        _record(event)
+        return False
+
+    def add(self, **counts) -> None:
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+
+def stage(name: str, **counts):
+    """Context manager timing one stage; `.add(**counts)` accumulates its counters."""
+    return _Stage(name, counts) if _enabled else _NULL_STAGE
+
+
+def add_counts(**counts) -> None:
+    # Add counters to the innermost stage running in this thread
+    if _enabled:
+        stack = _stack()
+        if stack:
+            stack[-1].add(**counts)
+
+
+def timed(name: Optional[str] = None) -> Callable:
+    """Decorator recording every call of the function as a stage."""
+    def decorate(func):
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Stage(label, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _run_traced(func: Callable, *args):
+    _local.buffer = []
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+    finally:
+        events, _local.buffer = _local.buffer, None
+    return result, events, time.perf_counter() - start
+
+
+def pool_map(pool, func: Callable, *iterables, name: str = 'pool', workers: Optional[int] = None) -> list:
+    """pool.map(func, *iterables) as a list, recording the pool's busy time and utilization.
+
+    workers defaults to the size of the pool, including the executors' own default size.
+    """
+    if not _enabled:
+        return list(pool.map(func, *iterables))
+    if workers is None:
+        workers = getattr(pool, '_max_workers', 1)
+
+    start = time.perf_counter()
+    results = []
+    busy = 0.0
+    for result, events, seconds in pool.map(_run_traced, itertools.repeat(func), *iterables):
+        results.append(result)
+        busy += seconds
+        with _lock:
+            _events.extend(events)
+    wall = time.perf_counter() - start
+    _record({'name': name, 'start': start - _origin, 'seconds': wall, 'pid': os.getpid(),
+             'thread': threading.get_ident(), 'max_rss_mib': max_rss_mib(), 'tasks': len(results),
+             'workers': workers, 'busy_seconds': busy,
+             'utilization': busy / (wall * workers) if wall > 0 else 0.0})
+    return results
+
+
+def map_batches(func: Callable, items: Sequence, workers: Optional[int] = None, name: str = 'pool') -> list:
+    """func(batch) for consecutive batches of items, in order, on a pool of worker processes.
+
+    Each worker gets a few large batches to keep pickling overhead low. With one
+    worker, or fewer than two items per worker, func runs once on all items here.
+    """
+    items = list(items)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(items) < 2 * workers:
+        return [func(items)]
+    nbatches = min(len(items), workers * 4)
+    size, extra = divmod(len(items), nbatches)
+    bounds = [i * size + min(i, extra) for i in range(nbatches + 1)]
+    batches = [items[start:stop] for start, stop in zip(bounds, bounds[1:])]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return pool_map(pool, func, batches, name=name, workers=workers)
+
+
+def summarize(events: Optional[List[dict]] = None) -> List[dict]:
+    """Calls, total/mean/max seconds and summed counters of every stage, in order of first use."""
+    rows = {}
+    for event in _events if events is None else events:
+        row = rows.setdefault(event['name'], {'name': event['name'], 'calls': 0, 'seconds': 0.0,
+                                              'max_seconds': 0.0, 'max_rss_mib': 0.0, 'counts': {}})
+        row['calls'] += 1
+        row['seconds'] += event['seconds']
+        row['max_seconds'] = max(row['max_seconds'], event['seconds'])
+        row['max_rss_mib'] = max(row['max_rss_mib'], event['max_rss_mib'])
+        for key, value in event.items():
+            if key not in EVENT_FIELDS and key != 'utilization':
+                row['counts'][key] = row['counts'].get(key, 0) + value
+    for row in rows.values():
+        row['mean_seconds'] = row['seconds'] / row['calls']
+        if 'busy_seconds' in row['counts']:
+            capacity = sum(event['seconds'] * event['workers'] for event in _events if event['name'] == row['name'])
+            row['counts']['utilization'] = row['counts']['busy_seconds'] / capacity if capacity else 0.0
+    return list(rows.values())
+
+
+def summary() -> str:
+    lines = [f"{'stage':<28} {'calls':>7} {'total s':>10} {'mean ms':>10} {'max ms':>10} {'RSS MiB':>9}  counters"]
+    for row in summarize():
+        counts = ', '.join(f'{key}={value:.3g}' if isinstance(value, float) else f'{key}={value}'
+                           for key, value in row['counts'].items())
+        lines.append(f"{row['name']:<28} {row['calls']:>7d} {row['seconds']:>10.4f} "
+                     f"{row['mean_seconds'] * 1e3:>10.3f} {row['max_seconds'] * 1e3:>10.3f} "
+                     f"{row['max_rss_mib']:>9.1f}  {counts}")
+    lines.append(f'peak RSS: {max_rss_mib():.1f} MiB, worker processes: {max_rss_mib(resource.RUSAGE_CHILDREN):.1f} MiB')
+    return '\n'.join(lines)
+
+
+def write_trace(trace_file: str) -> None:
+    meta = {'argv': sys.argv, 'pid': os.getpid(), 'max_rss_mib': max_rss_mib(),
+            'children_max_rss_mib': max_rss_mib(resource.RUSAGE_CHILDREN)}
+    with open(trace_file, 'w') as f:
+        json.dump({'meta': meta, 'summary': summarize(), 'events': _events}, f, indent=1)
+
+
+def report(file=None) -> None:
+    """Print the summary table (stderr by default) and write the JSON trace, if profiling is on."""
+    if not _enabled:
+        return
+    print(summary(), file=file or sys.stderr)
+    if _trace_file:
+        write_trace(_trace_file)
+        print(f'Profiling trace has been written to {_trace_file}.', file=file or sys.stderr)
@@ -1,10 +1,17 @@
 from __future__ import annotations
-from typing import Union, Tuple, List
+import argparse
+import functools
+import glob
+import os
+import sys
+from types import MappingProxyType
+from typing import Optional, Union, Tuple, List
 import numpy as np
 from collections import Counter
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-from plot_module import plot_function
+from poscar_module import read_poscar
+from profile_module import add_counts, add_profile_argument, map_batches, pool_map, report, stage, timed
+from neighbor_module import (PartialRDF, ShellTable, cell_list_pairs, normalize_rdf, pair_histogram, periodic_pairs,
+                             shell_table, site_shell_histogram, supercell_pairs)
 
 class simulation_cell:
     def __init__(self, vects: List[List[float]], origin: List[float]):
@@ -20,18 +27,126 @@ class simulation_cell:
     def get_cvect(self) -> List[float]:
         return self.vects[2]
 
+    def volume(self) -> float:
+        return float(cell_geometry(self.vects)[0][0])
+
+    def lengths(self) -> np.ndarray:
+        return cell_geometry(self.vects)[1][0]
+
+    def angles(self) -> np.ndarray:
+        return cell_geometry(self.vects)[2][0]
+
+    def reciprocal(self) -> np.ndarray:
+        return cell_geometry(self.vects)[3][0]
+
+
+def cell_geometry(vects) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Geometry of a stack of cells given as (n_cells, 3, 3) lattice vectors (rows), or one 3x3 cell.
+
+    Returns the volumes (n_cells,), lengths |a|, |b|, |c| (n_cells, 3), angles
+    alpha, beta, gamma in degrees (n_cells, 3) and reciprocal lattice vectors
+    as rows, including the 2*pi factor (n_cells, 3, 3).
+    """
+    vects = np.asarray(vects, dtype=float).reshape(-1, 3, 3)
+    a, b, c = vects[:, 0], vects[:, 1], vects[:, 2]
+
+    # Closed-form triple products are much faster than batched LAPACK calls for 3x3 cells
+    crosses = np.stack((np.cross(b, c), np.cross(c, a), np.cross(a, b)), axis=1)
+    determinants = np.einsum('ni,ni->n', a, crosses[:, 0])
+    volumes = np.abs(determinants)
+    lengths = np.linalg.norm(vects, axis=-1)
+
+    # alpha is the angle between b and c, beta between a and c, gamma between a and b
+    pairs = ([1, 0, 0], [2, 2, 1])
+    dots = np.einsum('nij,nij->ni', vects[:, pairs[0]], vects[:, pairs[1]])
+    cosines = dots / (lengths[:, pairs[0]] * lengths[:, pairs[1]])
+    angles = np.degrees(np.arccos(np.clip(cosines, -1.0, 1.0)))
+
+    reciprocal = 2 * np.pi * crosses / determinants[:, np.newaxis, np.newaxis]
+    return volumes, lengths, angles, reciprocal
+
+
+def adjugate(matrix: np.ndarray) -> np.ndarray:
+    # Integer adjugate of a 3x3 integer matrix, so that matrix @ adj = det * I
+    m = np.asarray(matrix, dtype=np.int64)
+    return np.array([[m[(j + 1) % 3, (i + 1) % 3] * m[(j + 2) % 3, (i + 2) % 3]
+                      - m[(j + 1) % 3, (i + 2) % 3] * m[(j + 2) % 3, (i + 1) % 3] for j in range(3)]
+                     for i in range(3)], dtype=np.int64)
+
+
+def hermite_diagonal(matrix: np.ndarray) -> Tuple[int, int, int]:
+    # Diagonal of the lower-triangular Hermite normal form U @ M (U unimodular), from
+    # integer row operations; its product is |det(M)|
+    rows = [[int(value) for value in row] for row in np.asarray(matrix)]
+    for col in (2, 1, 0):
+        while True:
+            nonzero = [r for r in range(col + 1) if rows[r][col]]
+            if not nonzero:
+                raise ValueError('The supercell matrix is singular')
+            pivot = min(nonzero, key=lambda r: abs(rows[r][col]))
+            if len(nonzero) == 1:
+                break
+            for r in nonzero:
+                if r != pivot:
+                    q = rows[r][col] // rows[pivot][col]
+                    rows[r] = [x - q * y for x, y in zip(rows[r], rows[pivot])]
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+    return abs(rows[0][0]), abs(rows[1][1]), abs(rows[2][2])
+
+
+def supercell_lattice_points(matrix: np.ndarray) -> np.ndarray:
+    """Parent lattice points n (integer rows) inside the supercell spanned by the rows of matrix.
+
+    The box [0, a) x [0, c) x [0, f) spanned by the Hermite normal form diagonal
+    holds exactly one point of every coset of the superlattice, so det(M) points
+    are generated directly, whatever the shape of the cell. Each one is moved
+    into the cell by subtracting floor(n @ adj(M) / det) @ M, exactly in integers.
+    Points are ordered with the first supercell coordinate running fastest, as
+    in System.replication.
+    """
+    matrix = np.asarray(matrix, dtype=np.int64)
+    adj = adjugate(matrix)
+    det = int(matrix[0] @ adj[:, 0])
+    points = np.indices(hermite_diagonal(matrix)).reshape(3, -1).T
+    points -= ((points @ adj) // det) @ matrix
+
+    k = points @ adj
+    return points[np.lexsort((k[:, 0], k[:, 1], k[:, 2]))]
+
+
+def species_dtype(nspecies: int) -> np.dtype:
+    # Smallest unsigned integer type that can index every species
+    return np.dtype(np.uint8) if nspecies <= 256 else np.dtype(np.uint16)
+
 
 class Atoms:
-    def __init__(self, natoms):
+    """Per-atom data: fractional positions as one contiguous (natoms, 3) array and the
+    species of every atom as a small integer index into System.symbols."""
+
+    __slots__ = ('natoms', 'pos', 'species')
+
+    def __init__(self, natoms, pos: Optional[np.ndarray] = None, species: Optional[np.ndarray] = None,
+                 dtype=np.float64):
         self.natoms = natoms
-        self.view = {'pos': np.zeros((natoms, 3)),
-                     'atype': np.zeros(natoms, dtype=int),
-                     'composition': np.empty(natoms, dtype='U20')}
+        self.pos = np.zeros((natoms, 3), dtype=dtype) if pos is None else np.ascontiguousarray(pos, dtype=dtype)
+        self.species = np.zeros(natoms, dtype=np.uint8) if species is None else species
+
+    @property
+    def atype(self) -> np.ndarray:
+        # 1-based atom types, as written by earlier versions
+        return self.species.astype(int) + 1
+
+    @property
+    def view(self) -> MappingProxyType:
+        # Read-only mapping of the per-atom arrays, kept for older scripts; writes raise instead of being lost
+        pos = self.pos.view()
+        atype = self.atype
+        pos.flags.writeable = atype.flags.writeable = False
+        return MappingProxyType({'pos': pos, 'atype': atype})
 
     def count_symbols(self) -> Counter:
-        symbols = self.view['atype']
-        symbol_counts = Counter(symbols)
-        return symbol_counts
+        counts = np.bincount(self.species)
+        return Counter({atype + 1: int(count) for atype, count in enumerate(counts) if count})
 
 
 class System:
@@ -44,123 +159,67 @@ class System:
 
 
     @classmethod
-    def poscar_read(cls, poscar_file: str) -> System:
-        with open(poscar_file, 'r') as file:
-            lines = file.readlines()
-
-            scale = float(lines[1].strip())
-
-            vects = []
-            for i in range(2, 5):
-                vect = [scale * float(x) for x in lines[i].split()]
-                vects.append(vect)
-
-            symbols = tuple(lines[5].split())
+    @timed('poscar_read')
+    def poscar_read(cls, poscar_file: str, dtype=np.float64) -> System:
+        # dtype=np.float32 halves the memory of the positions
+        poscar = read_poscar(poscar_file)
+        add_counts(atoms=poscar.natoms)
 
-            atom_counts = [int(x) for x in lines[6].split()]
-            natoms = sum(atom_counts)
+        simbox = simulation_cell(vects=poscar.vects, origin=[0.0, 0.0, 0.0])
+        species = np.repeat(np.arange(len(poscar.counts), dtype=species_dtype(len(poscar.counts))), poscar.counts)
+        atoms = Atoms(natoms=poscar.natoms, pos=poscar.pos, species=species, dtype=dtype)
 
-            pos_start = 8 if lines[7].lower().startswith('d') else 9
-            pos = []
-            what_type_atom = []
-            for i in range(pos_start, pos_start + natoms):
-                parts = lines[i].split()
-                pos.append([float(x) for x in parts[:3]])
-                what_type_atom.append(parts[3])
-
-            simbox = simulation_cell(vects=vects, origin=[0.0, 0.0, 0.0])
-            atoms = Atoms(natoms=natoms)
-            atoms.view['pos'] = np.array(pos)
-            atoms.view['atype'] = np.repeat(np.arange(len(atom_counts)) + 1, atom_counts)  # Assign atom types
-            atoms.view['what_type_atom'] = np.array(what_type_atom)
-
-            return cls(simbox=simbox, atoms=atoms, scale=True, symbols=symbols)
+        return cls(simbox=simbox, atoms=atoms, scale=True, symbols=poscar.symbols)
         
 
-    def calculate_nearest_neighbor_distance(self, neigh2plot) -> float:
-        pos = self.atoms.view['pos']
-        vects = self.simbox.vects
-    
-        pos_array = np.matmul(np.array(pos), vects)
-        dist_matrix = np.linalg.norm(pos_array[:, np.newaxis] - pos_array, axis=-1)
-    
-        np.fill_diagonal(dist_matrix, np.inf)
-    
-        flattened_matrix = np.ravel(dist_matrix)
-        sorted_matrix = np.sort(flattened_matrix)
-        rounded_matrix = np.round(sorted_matrix, decimals=3)
-        unique_distances, counts = np.unique(rounded_matrix, return_counts=True)
-        min_distance = unique_distances[0]
-    
-        with open("neighbour_info.dat", "w") as f:
-            f.write("Neighbor list in replicated POSCAR file\n")
-            f.write(f"Nearest neighbor distance: {min_distance}\n")
-            f.write("Neighbor distances: (angstrom), number of neighbors\n")
-            for i, distance in enumerate(unique_distances):
-                count = counts[i]
-                if np.isinf(distance):
-                    continue
-                ordinal_number = ""
-                if i == 0:
-                    ordinal_number = "1st"
-                elif i == 1:
-                    ordinal_number = "2nd"
-                elif i == 2:
-                    ordinal_number = "3rd"
-                else:
-                    ordinal_number = f"{i+1}th"
-                f.write(f"{ordinal_number} nearest neighbor distance: {distance:.3f}, number of neighbors: {count}\n")
-
-
-
-
-
-        filename = "neighbour_info.dat"
-        distances = []
-        counts = []
-        
-        with open(filename, 'r') as file:
-            lines = file.readlines()
-            start_reading = False
-            for line in lines:
-                if line.strip() == 'Neighbor distances: (angstrom), number of neighbors':
-                    start_reading = True
-                    continue
-                if not start_reading or line.strip() == '':
-                    continue
-                parts = line.split(',')
-                distance = float(parts[0].split(':')[1].strip())
-                count = int(parts[1].split(':')[1].strip())
-                distances.append(distance)
-                counts.append(count)
-        
-        cmap = cm.get_cmap('viridis')
-        
-        # Plot the distribution curve with contour colors
-        plot_function()
-        plt.bar(distances, counts, width=0.2, color=cmap(counts), edgecolor='black', linewidth=1)
-        plt.xlabel('Distance (angstrom)')
-        plt.ylabel('Number of Neighbors')
-        plt.title(f'Distribution up to {neigh2plot} \n nearest neighbor Distances')
-        x_limit = distances[neigh2plot] 
-        plt.xlim(0, x_limit)
-        # Save the plot as a PDF file
-        plt.savefig('neighbour_info.pdf', format='pdf')
-        
-        # Display the plot
-        plt.show()
+    def periodic_neighbor_shells(self, cutoff: float) -> List[Tuple[np.ndarray, np.ndarray]]:
+        # Per-site (distances, counts) of the bulk crystal, from periodic images of this cell
+        pairs = periodic_pairs(self.atoms.pos, self.simbox.vects, cutoff)
+        return site_shell_histogram(pairs, self.atoms.natoms, decimals=3)
 
-        return min_distance
+    @timed('neighbor_search')
+    def neighbor_shells(self, cutoff: Optional[float] = None, periodic: bool = False) -> ShellTable:
+        # In-memory shell table, with no file output or plotting
+        pos = self.atoms.pos
+        vects = self.simbox.vects
     
-    def replication(self, a_size: Union[int, Tuple[int, int]],
-                    b_size: Union[int, Tuple[int, int]],
-                    c_size: Union[int, Tuple[int, int]]) -> System:
+        if periodic:
+            if cutoff is None:
+                raise ValueError('A cutoff is required for periodic neighbor shells')
+            pairs = periodic_pairs(pos, vects, cutoff)
+        else:
+            pos_array = np.matmul(pos, vects)
+
+            # Pairs come from a linked-cell search, so memory no longer grows as N^2
+            pairs = cell_list_pairs(pos_array, pos_array, cutoff=cutoff,
+                                    self_index=np.arange(len(pos_array)))
+        table = shell_table(pairs, self.atoms.species, self.symbols, decimals=3)
+        add_counts(atoms=self.atoms.natoms, pairs=int(table.count.sum()), shells=len(table.distance))
+        return table
+
+    @timed('partial_rdf')
+    def partial_rdf(self, rmax: float, dr: float = 0.02) -> PartialRDF:
+        """Partial RDFs of every species pair of the periodic crystal, up to rmax.
+
+        Pairs are taken from the periodic images of the cell (so rmax may exceed
+        half the box) and binned chunk by chunk into fixed-width bins.
+        """
+        species = self.atoms.species
+        pairs = periodic_pairs(self.atoms.pos, self.simbox.vects, rmax)
+        hist = pair_histogram(pairs, species, len(self.symbols), rmax, dr)
+        species_counts = np.bincount(species, minlength=len(self.symbols))
+        return normalize_rdf(hist, dr, self.simbox.volume(), species_counts, self.symbols)
+
+    def calculate_nearest_neighbor_distance(self, neigh2plot, cutoff: Optional[float] = None,
+                                            periodic: bool = False, plot: bool = True,
+                                            info_file: str = 'neighbour_info.dat') -> float:
+        return report_neighbor_shells(self.neighbor_shells(cutoff, periodic), neigh2plot, cutoff, plot, info_file)
     
+    def _multipliers(self, a_size, b_size, c_size) -> Tuple[np.ndarray, np.ndarray]:
         sizes = [a_size, b_size, c_size]
         mults = np.array([0, 0, 0], dtype=int)
-        vects = self.simbox.vects
-        origin = self.simbox.origin
-        spos = self.atoms.view['pos']
+        vects = np.array(self.simbox.vects, dtype=float)
+        origin = np.array(self.simbox.origin, dtype=float)
 
     
         for i in range(3):
@@ -186,134 +245,402 @@ class System:
             if mults[i] == 0:
                 raise ValueError('Cannot multiply system dimension by zero')
     
-            spos[:, i] /= mults[i]
             origin += vects[i] * sizes[i][0]
     
-        vects = np.array(vects) * mults[:, np.newaxis]
-        simbox = simulation_cell(vects=vects, origin=origin)
-        natoms = self.atoms.natoms * mults[0] * mults[1] * mults[2]
-        atoms = Atoms(natoms=natoms)
-    
-        for key in self.atoms.view.keys():
-            if key == 'pos':
-                continue
-    
-            # Get old array
-            old = self.atoms.view[key]
-    
-            new = np.empty((mults[0] * mults[1] * mults[2],) + old.shape, dtype=old.dtype)
-            new[:] = old
-            new_shape = new.shape
-            new_shape = (new_shape[0] * new_shape[1],) + new_shape[2:]
-            atoms.view[key] = np.array(new.reshape(new_shape))
-    
-        new_position = np.empty((mults[0] * mults[1] * mults[2],) + spos.shape)
-        new_position[:] = spos
-        # print(new_position)
-        new_shape = new_position.shape
-        new_shape = (new_shape[0] * new_shape[1],) + new_shape[2:]
-        new_position = new_position.reshape(new_shape)
-    
-        test = np.empty(mults[0] * self.atoms.natoms)
-        test.shape = (self.atoms.natoms, mults[0])
-        test[:] = np.arange(mults[0])
-        x = test.T.flatten()
+        return mults, origin
+
+    @timed('replication')
+    def replication(self, a_size: Union[int, Tuple[int, int]],
+                    b_size: Union[int, Tuple[int, int]],
+                    c_size: Union[int, Tuple[int, int]], lazy: bool = False) -> Union[System, LazySupercell]:
     
-        test = np.empty(mults[1] * len(x))
-        test.shape = (len(x), mults[1])
-        test[:] = np.arange(mults[1])
-        y = test.T.flatten()
-        test.shape = (mults[1], len(x))
-        test[:] = x
-        x = test.flatten()
+        mults, origin = self._multipliers(a_size, b_size, c_size)
+        vects = np.array(self.simbox.vects, dtype=float)
+        simbox = simulation_cell(vects=vects * mults[:, np.newaxis], origin=origin)
+        if lazy:
+            return LazySupercell(parent=self, mults=mults, simbox=simbox)
+
+        nimages = int(np.prod(mults))
+        natoms = self.atoms.natoms * nimages
     
-        test = np.empty(mults[2] * len(x))
-        test.shape = (len(x), mults[2])
-        test[:] = np.arange(mults[2])
-        z = test.T.flatten()
-        test.shape = (mults[2], len(x))
-        test[:] = x
-        x = test.flatten()
-        test[:] = y
-        y = test.flatten()
+        # Species codes are repeated once per image, image-major
+        species = np.tile(self.atoms.species, nimages)
+
+        # Image offsets with the a index running fastest, broadcast against the
+        # scaled parent positions into a single (images, natoms, 3) block
+        dtype = self.atoms.pos.dtype
+        grid = np.indices(mults[::-1]).reshape(3, nimages).T[:, ::-1]
+        offsets = (grid * (1.0 / mults)).astype(dtype, copy=False)
+        spos = (self.atoms.pos / mults).astype(dtype, copy=False)
+        pos = np.empty((nimages, self.atoms.natoms, 3), dtype=dtype)
+        np.add(spos[np.newaxis], offsets[:, np.newaxis], out=pos)
+        atoms = Atoms(natoms=natoms, pos=pos.reshape(natoms, 3), species=species, dtype=dtype)
+        add_counts(atoms=natoms)
     
-        xyz = (np.hstack((x[:, np.newaxis], y[:, np.newaxis], z[:, np.newaxis]))
-               * np.array([1 / mults[0], 1 / mults[1], 1 / mults[2]]))
+        return System(simbox=simbox, atoms=atoms, scale=True, symbols=self.symbols)
 
-        atoms.view['pos'] = new_position + xyz
-        pos = atoms.view['pos']
-        what_type_atom = atoms.view['what_type_atom']
 
-    
+    @timed('supercell')
+    def supercell(self, matrix, chunk_size: int = 65536) -> System:
+        """Supercell spanned by the rows of an integer 3x3 matrix M, with vectors M @ V.
+
+        Every parent atom is placed at every parent lattice point inside the new
+        cell and wrapped into it. M must have a positive determinant, and the
+        result has det(M) times as many atoms, in image-major order.
+        """
+        matrix = np.asarray(matrix)
+        if matrix.shape != (3, 3) or not np.array_equal(matrix, np.round(matrix)):
+            raise TypeError('The supercell matrix must be a 3x3 integer matrix')
+        matrix = matrix.astype(np.int64)
+        adj = adjugate(matrix)
+        det = int(matrix[0] @ adj[:, 0])
+        if det <= 0:
+            raise ValueError(f'The supercell matrix must have a positive determinant, got {det}')
+
+        # The supercell holds det(M) times the parent atoms, one copy per lattice point
+        points = supercell_lattice_points(matrix)
+        if len(points) != det:
+            raise ValueError(f'Found {len(points)} lattice points in the supercell, expected det(M) = {det}')
+        vects = matrix @ np.array(self.simbox.vects, dtype=float)
+        simbox = simulation_cell(vects=vects, origin=[0.0, 0.0, 0.0])
+
+        # New fractional coordinates are (f + n) @ adj(M) / det; the lattice part is
+        # exact in integers and the coordinates are wrapped modulo det
+        natoms_cell = self.atoms.natoms
+        natoms = natoms_cell * det
+        dtype = self.atoms.pos.dtype
+        offsets = (points @ adj).astype(float)
+        spos = self.atoms.pos.astype(float) @ adj
+        pos = np.empty((det, natoms_cell, 3), dtype=dtype)
+        images_per_chunk = max(1, chunk_size // natoms_cell)
+        for first in range(0, det, images_per_chunk):
+            block = offsets[first:first + images_per_chunk, np.newaxis] + spos[np.newaxis]
+            block = (np.mod(block, det) / det).astype(dtype, copy=False)
+            block[block >= 1.0] = 0.0
+            pos[first:first + len(block)] = block
+
+        atoms = Atoms(natoms=natoms, pos=pos.reshape(natoms, 3), species=np.tile(self.atoms.species, det), dtype=dtype)
+        add_counts(atoms=natoms, images=det)
         return System(simbox=simbox, atoms=atoms, scale=True, symbols=self.symbols)
 
 
+class LazySupercell:
+    """Replicated view of a System whose coordinates are generated on demand."""
 
-def replicate_poscar(system, a_size, b_size, c_size, output_file,neigh2plot):
-    # Call the replication method
-    new_system = system.replication(a_size, b_size, c_size)
+    def __init__(self, parent: System, mults: np.ndarray, simbox: simulation_cell):
+        self.parent = parent
+        self.mults = np.asarray(mults, dtype=int)
+        self.simbox = simbox
+        self.symbols = parent.symbols
+        self.nimages = int(np.prod(self.mults))
+        self.natoms = parent.atoms.natoms * self.nimages
 
-    with open(output_file, 'w') as file:
+    def count_symbols(self) -> Counter:
+        return Counter({key: count * self.nimages for key, count in self.parent.atoms.count_symbols().items()})
+
+    def species_counts(self) -> Counter:
+        counts = np.bincount(self.parent.atoms.species, minlength=len(self.symbols))
+        return Counter({symbol: int(count) * self.nimages for symbol, count in zip(self.symbols, counts) if count})
+
+    def iter_chunks(self, chunk_size: int = 65536):
+        # Yields (pos, species) for blocks of whole images, in the same order and
+        # with the same values as System.replication
+        atoms = self.parent.atoms
+        spos = (atoms.pos / self.mults).astype(atoms.pos.dtype, copy=False)
+        images_per_chunk = max(1, chunk_size // self.parent.atoms.natoms)
+        m0, m1, _ = self.mults
+        for first in range(0, self.nimages, images_per_chunk):
+            image = np.arange(first, min(first + images_per_chunk, self.nimages))
+            grid = np.column_stack((image % m0, (image // m0) % m1, image // (m0 * m1)))
+            offsets = (grid * (1.0 / self.mults)).astype(atoms.pos.dtype, copy=False)
+            pos = (spos[np.newaxis] + offsets[:, np.newaxis]).reshape(-1, 3)
+            yield pos, np.tile(atoms.species, len(image))
+
+    @timed('neighbor_search')
+    def neighbor_shells(self, cutoff: float) -> ShellTable:
+        if cutoff is None:
+            raise ValueError('A cutoff is required for neighbor shells of a lazy supercell')
+        pairs = supercell_pairs(self.parent.atoms.pos, self.parent.simbox.vects, self.mults, cutoff)
+        table = shell_table(pairs, self.parent.atoms.species, self.symbols, decimals=3)
+        add_counts(atoms=self.natoms, pairs=int(table.count.sum()), shells=len(table.distance))
+        return table
+
+    def calculate_nearest_neighbor_distance(self, neigh2plot, cutoff: float, plot: bool = True,
+                                            info_file: str = 'neighbour_info.dat') -> float:
+        return report_neighbor_shells(self.neighbor_shells(cutoff), neigh2plot, cutoff, plot, info_file)
+
+
+def _rdf_batch(poscar_files: List[str], rmax: float, dr: float) -> Tuple[Tuple[str], np.ndarray, np.ndarray]:
+    # Sum of g and of the pair counts over one batch of structures
+    g_sum = counts_sum = symbols = None
+    for poscar_file in poscar_files:
+        rdf = System.poscar_read(poscar_file).partial_rdf(rmax, dr)
+        if symbols is None:
+            symbols, g_sum, counts_sum = rdf.symbols, rdf.g, rdf.counts
+        elif rdf.symbols != symbols:
+            raise ValueError(f'{poscar_file}: species {rdf.symbols} do not match {symbols}')
+        else:
+            g_sum = g_sum + rdf.g
+            counts_sum = counts_sum + rdf.counts
+    return symbols, g_sum, counts_sum
+
+
+def average_partial_rdf(poscar_files: List[str], rmax: float, dr: float = 0.02,
+                        workers: Optional[int] = None) -> PartialRDF:
+    """Partial RDFs averaged over many structures (e.g. the CONTCARs of a campaign).
+
+    Every file must list the same species. Files are read and binned in
+    batches on a pool of worker processes.
+    """
+    if not poscar_files:
+        raise ValueError('No structures to average')
+    batches = map_batches(functools.partial(_rdf_batch, rmax=rmax, dr=dr), poscar_files, workers=workers,
+                          name='partial_rdf.pool')
+
+    symbols = batches[0][0]
+    for batch_symbols, _, _ in batches:
+        if batch_symbols != symbols:
+            raise ValueError(f'Species {batch_symbols} do not match {symbols}')
+    g = sum(batch[1] for batch in batches) / len(poscar_files)
+    counts = sum(batch[2] for batch in batches)
+    nbins = g.shape[-1]
+    return PartialRDF(r=(np.arange(nbins) + 0.5) * dr, g=g, counts=counts, symbols=symbols)
+
+
+def report_neighbor_shells(table: ShellTable, neigh2plot, cutoff: Optional[float], plot: bool = True,
+                           info_file: str = 'neighbour_info.dat') -> float:
+    # Write the shells (and the plot) and return the nearest neighbor distance
+    if len(table.distance) == 0:
+        raise ValueError(f'No pairs within cutoff {cutoff} angstrom')
+    write_neighbor_info(table, info_file)
+    if plot:
+        plot_neighbor_shells(table, neigh2plot, os.path.splitext(info_file)[0] + '.pdf')
+    return table.distance[0]
+
+
+@timed('write_neighbor_info')
+def write_neighbor_info(table: ShellTable, filename: str = "neighbour_info.dat") -> None:
+    min_distance = table.distance[0]
+    
+    with open(filename, "w") as f:
+        f.write("Neighbor list in replicated POSCAR file\n")
+        f.write(f"Nearest neighbor distance: {min_distance}\n")
+        f.write("Neighbor distances: (angstrom), number of neighbors\n")
+        for i, distance in enumerate(table.distance):
+            count = table.count[i]
+            ordinal_number = ""
+            if i == 0:
+                ordinal_number = "1st"
+            elif i == 1:
+                ordinal_number = "2nd"
+            elif i == 2:
+                ordinal_number = "3rd"
+            else:
+                ordinal_number = f"{i+1}th"
+            f.write(f"{ordinal_number} nearest neighbor distance: {distance:.3f}, number of neighbors: {count}\n")
+
+
+@timed('plot')
+def plot_neighbor_shells(table: ShellTable, neigh2plot, filename: str = 'neighbour_info.pdf',
+                         show: bool = False) -> None:
+    # matplotlib is only imported when a plot is actually requested
+    from plot_module import plot_function, save_figure
+    import matplotlib.pyplot as plt
+
+    cmap = plt.get_cmap('viridis')
+    
+    # Plot the distribution curve with contour colors
+    fig, ax = plot_function()
+    ax.bar(table.distance, table.count, width=0.2, color=cmap(table.count), edgecolor='black', linewidth=1)
+    ax.set_xlabel('Distance (angstrom)')
+    ax.set_ylabel('Number of Neighbors')
+    ax.set_title(f'Distribution up to {neigh2plot} \n nearest neighbor Distances')
+    x_limit = table.distance[min(neigh2plot, len(table.distance) - 1)]
+    ax.set_xlim(0, x_limit)
+
+    # Save the plot as a PDF file and release the figure
+    save_figure(fig, filename, show=show)
+
+
+def _write_rows(file, rows: np.ndarray) -> None:
+    # One formatting call per chunk instead of one per coordinate
+    with stage('write_poscar.format'):
+        text = ('%.16f %.16f %.16f\n' * len(rows)) % tuple(rows.ravel().tolist())
+    with stage('write_poscar.io', bytes_written=len(text)):
+        file.write(text)
+
+
+@timed('write_poscar')
+def write_poscar(system: Union[System, LazySupercell], output_file: str, chunk_size: int = 65536) -> None:
+    lazy = isinstance(system, LazySupercell)
+    atoms = system.parent.atoms if lazy else system.atoms
+
+    # Species present, in order of first appearance; codes only become labels here
+    counts = np.bincount(atoms.species, minlength=len(system.symbols))
+    present = sorted(np.flatnonzero(counts), key=lambda code: int(np.argmax(atoms.species == code)))
+    labels = [system.symbols[code] for code in present]
+    counts = counts[present] * (system.nimages if lazy else 1)
+
+    with open(output_file, 'w', buffering=1 << 20) as file:
         file.write('replicated poscar\n')
         file.write('1.0\n')
-        for vector in new_system.simbox.vects:
+        for vector in system.simbox.vects:
             file.write(' '.join(f'{value:.16f}' for value in vector)+ '\n')
-        combined_array = np.column_stack((new_system.atoms.view['pos'], new_system.atoms.view['what_type_atom']))
-        unique_values, indices = np.unique(combined_array[:, 3], return_index=True)
-        sorted_unique_values = unique_values[np.argsort(indices)]
-        for i in range(len(sorted_unique_values)):
-            file.write(sorted_unique_values[i])
-            if i < len(sorted_unique_values) - 1:
-                file.write(' ')
-
-        value_to_index = {value: index for index, value in enumerate(sorted_unique_values)}
-        sorted_array = combined_array[np.argsort([value_to_index[value] for value in combined_array[:, 3]])]
-        unique_strings = np.unique(sorted_array[:, -1])  
-        string_to_numeric = {}
-        numeric_value = 1
-        for string in sorted_array[:, -1]:
-            if string not in string_to_numeric:
-                string_to_numeric[string] = str(numeric_value)
-                numeric_value += 1
-        for i in range(len(sorted_array)):
-            sorted_array[i, -1] = string_to_numeric[sorted_array[i, -1]]
-        unique_values, counts = np.unique(sorted_array[:, 3], return_counts=True)
-        counts_str = ' '.join(map(str, counts))
-        file.write('\n'+counts_str)
+        file.write(' '.join(labels))
+        file.write('\n' + ' '.join(map(str, counts)))
         file.write('\nDirect\n')
-        sorted_array = sorted_array[:, :-1]
-
-        for row in sorted_array:
-            formatted_row = ['{:.16f}'.format(float(element)) for element in row]
-            file.write(' '.join(formatted_row) + '\n')
 
-    nearest_neighbor_distance= new_system.calculate_nearest_neighbor_distance(neigh2plot)
+        if lazy:
+            # One pass over the generated images per species keeps memory constant
+            parent_natoms = atoms.natoms
+            for code in present:
+                mask = atoms.species == code
+                for pos, _ in system.iter_chunks(chunk_size):
+                    _write_rows(file, pos.reshape(-1, parent_natoms, 3)[:, mask].reshape(-1, 3))
+        else:
+            # Grouping by species with one scan per species keeps the original
+            # atom order within each species, without a full sort
+            for code in present:
+                with stage('write_poscar.sort'):
+                    order = np.flatnonzero(atoms.species == code)
+                for start in range(0, len(order), chunk_size):
+                    _write_rows(file, atoms.pos[order[start:start + chunk_size]])
+
+
+def replicate_poscar(system, a_size, b_size, c_size, output_file, neigh2plot, cutoff=None, periodic=False,
+                     lazy=False, plot=True, info_file='neighbour_info.dat', matrix=None):
+    # Call the replication method, or build the supercell of a general matrix instead of the sizes
+    if matrix is not None:
+        if lazy:
+            raise ValueError('Lazy supercells only support diagonal multipliers')
+        new_system = system.supercell(matrix)
+    else:
+        new_system = system.replication(a_size, b_size, c_size, lazy=lazy)
+    write_poscar(new_system, output_file)
+
+    # Periodic shells come straight from the unit cell and do not depend on the replication size
+    if periodic:
+        nearest_neighbor_distance = system.calculate_nearest_neighbor_distance(neigh2plot, cutoff, periodic=True,
+                                                                               plot=plot, info_file=info_file)
+    else:
+        nearest_neighbor_distance = new_system.calculate_nearest_neighbor_distance(neigh2plot, cutoff, plot=plot,
+                                                                                   info_file=info_file)
     return nearest_neighbor_distance
 
 
-######################### user inputs ############################
+def _replicate_job(poscar_file, sizes, output_file, info_file, options) -> Tuple[str, Optional[float], Optional[str]]:
+    # One batch entry; failures are reported instead of stopping the batch
+    try:
+        system = System.poscar_read(poscar_file)
+        distance = replicate_poscar(system, *sizes, output_file, info_file=info_file, **options)
+    except Exception as error:
+        return poscar_file, None, f'{type(error).__name__}: {error}'
+    return poscar_file, distance, None
+
+
+def read_manifest(manifest_file: str, sizes: List[int]) -> List[Tuple[str, List[int]]]:
+    """Entries of a manifest: one POSCAR path per line, optionally followed by its own
+    a b c multipliers. Blank lines and lines starting with # are skipped."""
+    entries = []
+    base = os.path.dirname(manifest_file)
+    with open(manifest_file) as f:
+        for line in f:
+            parts = line.split('#')[0].split()
+            if not parts:
+                continue
+            if len(parts) not in (1, 4):
+                raise ValueError(f'{manifest_file}: expected "path [a b c]", got {line.strip()!r}')
+            entry_sizes = [int(size) for size in parts[1:]] or sizes
+            entries.append((os.path.join(base, parts[0]), entry_sizes))
+    return entries
+
+
+def batch_jobs(entries: List[Tuple[str, List[int]]], output_file: str) -> List[tuple]:
+    # The first entry of a path wins, so manifest sizes take precedence over a --batch match
+    unique = {}
+    for path, sizes in entries:
+        unique.setdefault(os.path.normpath(path), sizes)
+    # Outputs go next to each input; inputs sharing a directory get their file name as a suffix
+    directories = [os.path.dirname(path) for path in unique]
+    jobs = []
+    for (path, sizes), directory in zip(unique.items(), directories):
+        suffix = f'_{os.path.basename(path)}' if directories.count(directory) > 1 else ''
+        jobs.append((path, sizes, os.path.join(directory, output_file + suffix),
+                     os.path.join(directory, f'neighbour_info{suffix}.dat')))
+    return jobs
+
+
+def replicate_batch(jobs: List[tuple], options: dict, workers: Optional[int] = None) -> List[tuple]:
+    """Run (poscar, sizes, output, info_file) jobs in one process, or on a pool of workers.
+
+    Returns (poscar, nearest neighbor distance, error) for every job, in order.
+    """
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    columns = list(zip(*jobs)) + [[options] * len(jobs)]
+    if workers <= 1:
+        return [_replicate_job(*job) for job in zip(*columns)]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return pool_map(pool, _replicate_job, *columns, name='replicate.pool', workers=workers)
 
 
 def main():
-    # Define POSCAR file
-    poscar_file = 'POSCAR'
-    system = System.poscar_read(poscar_file)
-
-    # Define the sizes for replication
-    a_size = 3
-    b_size = 2
-    c_size = 4
-    
-    # Define the output file name
-    output_file = 'replicated_POSCAR'
-    
-    # Define number of neighbor distance
-    neigh2plot = 10 
-    replicate_poscar(system, a_size, b_size, c_size, output_file, neigh2plot)
+    parser = argparse.ArgumentParser(description='Replicate a POSCAR into a supercell and list its neighbor shells')
+    parser.add_argument('poscar', nargs='?', default='POSCAR', help='input POSCAR file (default: POSCAR)')
+    parser.add_argument('-n', '--size', type=int, nargs=3, default=[3, 2, 4], metavar=('A', 'B', 'C'),
+                        help='replication along a, b and c (default: 3 2 4)')
+    parser.add_argument('-m', '--matrix', type=int, nargs=9, default=None, metavar='M',
+                        help='integer 3x3 supercell matrix, row by row, instead of -n (new vectors are M @ V)')
+    parser.add_argument('-o', '--output', default='replicated_POSCAR', help='replicated POSCAR file name')
+    parser.add_argument('--neigh2plot', type=int, default=10, help='number of neighbor distances to plot')
+    parser.add_argument('--cutoff', type=float, default=None,
+                        help='neighbor search cutoff in angstrom (default: keep every pair)')
+    parser.add_argument('--periodic', action='store_true',
+                        help='neighbor shells from periodic images of the input cell (needs --cutoff)')
+    parser.add_argument('--lazy', action='store_true',
+                        help='generate the supercell on the fly instead of in memory (needs --cutoff)')
+    parser.add_argument('--no-plot', action='store_true', help='skip the plot and the matplotlib import')
+    parser.add_argument('--batch', nargs='+', default=None, metavar='PATTERN',
+                        help='replicate every POSCAR matching the glob patterns, writing next to each input')
+    parser.add_argument('--manifest', default=None,
+                        help='file listing one POSCAR per line, optionally followed by its own A B C')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='worker processes in batch mode')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    if (args.periodic or args.lazy) and args.cutoff is None:
+        parser.error('--periodic and --lazy need a --cutoff')
+    if args.matrix is not None and args.lazy:
+        parser.error('--lazy only supports the diagonal sizes of -n')
+
+    options = {'neigh2plot': args.neigh2plot, 'cutoff': args.cutoff, 'periodic': args.periodic,
+               'lazy': args.lazy, 'plot': not args.no_plot,
+               'matrix': None if args.matrix is None else np.reshape(args.matrix, (3, 3))}
+
+    if args.batch is None and args.manifest is None:
+        system = System.poscar_read(args.poscar)
+        replicate_poscar(system, *args.size, args.output, **options)
+        report()
+        return
+
+    entries = read_manifest(args.manifest, args.size) if args.manifest else []
+    for pattern in args.batch or []:
+        entries += [(path, args.size) for path in sorted(glob.glob(pattern))]
+    if not entries:
+        parser.error('no input files found for the batch')
+
+    results = replicate_batch(batch_jobs(entries, args.output), options, workers=args.workers)
+    failed = 0
+    for poscar_file, distance, error in results:
+        if error is None:
+            print(f'{poscar_file}: nearest neighbor distance {distance}')
+        else:
+            failed += 1
+            print(f'{poscar_file}: failed: {error}', file=sys.stderr)
+    print(f'{len(results) - failed} of {len(results)} structures replicated.')
+    report()
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
     main()
-
-
-
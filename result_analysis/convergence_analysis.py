@@ -0,0 +1,211 @@
+"""
+1. Place the OSZICAR_n files (and optionally the OUTCAR_n files, e.g. collected with `copy_files.py -f OSZICAR OUTCAR`) in one directory, or pass their directories on the command line.
+2. Run the script using the command:
+
+    python convergence_analysis.py [directory ...] [--fmax 0.02] [--ediff 1e-4] [--workers N]
+
+   or call `parse_trajectory(oszicar, outcar)` from Python to get every ionic step of a run as NumPy arrays.
+
+
+## Output
+
+- `convergence.txt`: One CSV line per run, with the number of ionic steps, the final F, E0, dE and magnetic moment, the largest force and stress component of the last step, and whether the run is converged.
+
+- `convergence.npy`: The same table as a NumPy structured array (see `results_store.load_results`).
+
+A run is converged when the largest force of its last ionic step is at most `--fmax` (eV/angstrom), or, when there is no OUTCAR with forces, when the energy change |dE| of its last step is at most `--ediff` (eV).
+
+## Parsing
+
+Each file is memory-mapped and the ionic steps are extracted with regular expressions over the whole buffer, so no Python loop runs over lines:
+
+- OSZICAR: `F=`, `E0=`, `d E =` and `mag=` of every ionic step.
+- OUTCAR: every complete `TOTAL-FORCE (eV/Angst)` block, and every `in kB` stress line, in a single pass.
+
+Runs are parsed in batches on a pool of worker processes, and `--profile` reports the time and bytes of every stage.
+"""
+
+import argparse
+import functools
+import mmap
+import os
+import re
+import sys
+from typing import List, Optional
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from profile_module import add_counts, add_profile_argument, map_batches, report, stage, timed
+from results_store import export_csv, save_results
+from simulation_analysis import find_runs
+
+# Ionic step lines of an OSZICAR, e.g. "   3 F= -.61E+02 E0= -.611E+02  d E =-.6E+02  mag=    11.5"
+IONIC_STEP = re.compile(rb'^\s*\d+\s+F=\s*(\S+)\s+E0=\s*(\S+)\s+d E\s*=\s*(\S+)(?:\s+mag=\s*(\S+))?', re.M)
+
+NIONS = re.compile(rb'NIONS\s*=\s*(\d+)')
+
+# One pass over an OUTCAR finds both the stress lines (group 1) and the body of every force block
+# (group 2), between the dashed rules under the POSITION/TOTAL-FORCE header. The rules are matched
+# as whole lines, since position lines start with a minus sign for negative x
+OUTCAR_STEP = re.compile(rb'^\s*in kB((?:\s+\S+){6})'
+                         rb'|TOTAL-FORCE \(eV/Angst\)[^\n]*\n[ \t]*-{10,}[ \t\r]*\n(.*?)\n[ \t]*-{10,}[ \t\r]*$',
+                         re.S | re.M)
+
+CONVERGENCE_DTYPE = np.dtype([('File_number', np.int64), ('nsteps', np.int64), ('F', np.float64),
+                              ('E0', np.float64), ('dE', np.float64), ('mag', np.float64),
+                              ('max_force', np.float64), ('max_stress', np.float64), ('converged', np.bool_)])
+
+
+class Trajectory:
+    """Every ionic step of one run: OSZICAR energies and moments, OUTCAR forces and stress.
+
+    forces is (steps, natoms, 3) in eV/angstrom and stress (steps, 6) in kB
+    (xx yy zz xy yz zx); both are None without an OUTCAR.
+    """
+
+    def __init__(self, F: np.ndarray, E0: np.ndarray, dE: np.ndarray, mag: np.ndarray,
+                 forces: Optional[np.ndarray] = None, stress: Optional[np.ndarray] = None):
+        self.F = F
+        self.E0 = E0
+        self.dE = dE
+        self.mag = mag
+        self.forces = forces
+        self.stress = stress
+
+    @property
+    def nsteps(self) -> int:
+        return len(self.E0)
+
+    def max_force(self) -> Optional[np.ndarray]:
+        # Largest atomic force of every ionic step
+        if self.forces is None:
+            return None
+        return np.sqrt((self.forces ** 2).sum(axis=-1)).max(axis=-1, initial=0.0)
+
+
+def _to_float(values: List[bytes], shape: tuple) -> np.ndarray:
+    # Fortran overflows (********) and missing fields become NaN
+    array = np.array(values, dtype='S32')
+    try:
+        return array.astype(float).reshape(shape)
+    except ValueError:
+        return np.array([float(value) if value and not value.startswith(b'*') else np.nan for value in values],
+                        dtype=float).reshape(shape)
+
+
+def _map(path: str):
+    # Memory-mapped contents of a file, or b'' for an empty file
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def parse_oszicar(oszicar_path: str) -> np.ndarray:
+    """(steps, 4) array of F, E0, dE and mag of every ionic step (mag is NaN when absent)."""
+    buffer = _map(oszicar_path)
+    try:
+        add_counts(bytes_mapped=len(buffer))
+        steps = IONIC_STEP.findall(buffer)
+    finally:
+        if isinstance(buffer, mmap.mmap):
+            buffer.close()
+    return _to_float([value or b'nan' for step in steps for value in step], (len(steps), 4))
+
+
+def parse_outcar(outcar_path: str) -> tuple:
+    """Forces (steps, natoms, 3) of every complete force block, and stress (steps, 6) in kB."""
+    buffer = _map(outcar_path)
+    try:
+        add_counts(bytes_mapped=len(buffer))
+        # NIONS is in the header, so this search stops within the first pages
+        nions = NIONS.search(buffer)
+        natoms = int(nions.group(1)) if nions else 0
+        matches = OUTCAR_STEP.findall(buffer)
+    finally:
+        if isinstance(buffer, mmap.mmap):
+            buffer.close()
+
+    # A block cut short by a running job is dropped
+    stress_lines = [line for line, block in matches if line]
+    values = [block.split() for line, block in matches if not line]
+    values = [value for value in values if natoms and len(value) == natoms * 6]
+    forces = _to_float([field for value in values for field in value], (len(values), natoms, 6))[..., 3:]
+    stress = _to_float([field for line in stress_lines for field in line.split()], (len(stress_lines), 6))
+    return forces, stress
+
+
+@timed('parse_trajectory')
+def parse_trajectory(oszicar_path: str, outcar_path: Optional[str] = None) -> Trajectory:
+    steps = parse_oszicar(oszicar_path)
+    forces = stress = None
+    if outcar_path is not None and os.path.isfile(outcar_path):
+        forces, stress = parse_outcar(outcar_path)
+    add_counts(steps=len(steps))
+    return Trajectory(F=steps[:, 0], E0=steps[:, 1], dE=steps[:, 2], mag=steps[:, 3], forces=forces, stress=stress)
+
+
+def summarize_run(file_number: int, trajectory: Trajectory, fmax: float, ediff: float) -> tuple:
+    if trajectory.nsteps == 0:
+        return file_number, 0, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, False
+    max_force = trajectory.max_force()
+    final_force = max_force[-1] if max_force is not None and len(max_force) else np.nan
+    has_stress = trajectory.stress is not None and len(trajectory.stress)
+    final_stress = np.abs(trajectory.stress[-1]).max() if has_stress else np.nan
+    if np.isnan(final_force):
+        converged = bool(abs(trajectory.dE[-1]) <= ediff)
+    else:
+        converged = bool(final_force <= fmax)
+    return (file_number, trajectory.nsteps, trajectory.F[-1], trajectory.E0[-1], trajectory.dE[-1],
+            trajectory.mag[-1], final_force, final_stress, converged)
+
+
+def _summarize_runs(directory: str, file_numbers: List[int], fmax: float, ediff: float) -> List[tuple]:
+    rows = []
+    for file_number in file_numbers:
+        trajectory = parse_trajectory(os.path.join(directory, f'OSZICAR_{file_number}'),
+                                      os.path.join(directory, f'OUTCAR_{file_number}'))
+        rows.append(summarize_run(file_number, trajectory, fmax, ediff))
+    return rows
+
+
+@timed('analyze_convergence')
+def analyze_convergence(directory: str = './', fmax: float = 0.02, ediff: float = 1e-4,
+                        workers: Optional[int] = None, file_numbers: Optional[List[int]] = None) -> np.ndarray:
+    """Final-step summary of every OSZICAR_n/OUTCAR_n run as a structured array with CONVERGENCE_DTYPE fields."""
+    if file_numbers is None:
+        file_numbers = find_runs(directory)
+    add_counts(runs=len(file_numbers))
+
+    batches = map_batches(functools.partial(_summarize_runs, directory, fmax=fmax, ediff=ediff), file_numbers,
+                          workers=workers, name='convergence.pool')
+    rows = [row for batch in batches for row in batch]
+    return np.array(rows, dtype=CONVERGENCE_DTYPE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Screen the ionic convergence of VASP runs')
+    parser.add_argument('directories', nargs='*', default=['./'],
+                        help='directories containing the OSZICAR_n (and OUTCAR_n) files')
+    parser.add_argument('--fmax', type=float, default=0.02, help='force criterion in eV/angstrom')
+    parser.add_argument('--ediff', type=float, default=1e-4,
+                        help='energy criterion in eV, used for runs without OUTCAR forces')
+    parser.add_argument('-o', '--output', default='convergence.txt', help='CSV output file name')
+    parser.add_argument('--store', default='convergence.npy',
+                        help='binary results store (.npy, or .parquet with pandas)')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of worker processes')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
+    for directory in args.directories:
+        results = analyze_convergence(directory, fmax=args.fmax, ediff=args.ediff, workers=args.workers)
+        with stage('save_results'):
+            save_results(results, os.path.join(directory, args.store))
+            export_csv(results, os.path.join(directory, args.output))
+        print(f'{os.path.join(directory, args.output)}: {int(results["converged"].sum())} of {len(results)} '
+              f'runs converged.')
+    report()
+
+
+if __name__ == '__main__':
+    main()
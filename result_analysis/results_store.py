@@ -0,0 +1,60 @@
+"""
+Compact columnar storage for simulation_analysis results.
+
+Results are NumPy structured arrays. They are stored as a `.npy` file that
+can be memory-mapped, so later scripts can pick a few columns from a large
+result set without loading or copying the whole file:
+
+    results = load_results('sim_results.npy', columns=['PeratomV', 'PeratomE'])
+
+A `.parquet` path is written and read with pandas instead (needs pyarrow or
+fastparquet). `export_csv` writes the plain-text `sim_results.txt` layout.
+"""
+
+import contextlib
+import os
+from typing import List, Optional
+import numpy as np
+
+
+def _is_parquet(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() == '.parquet'
+
+
+@contextlib.contextmanager
+def atomic_write(path: str):
+    """Binary file to write path through, which replaces path only once it is complete."""
+    # Write next to the target and rename, so readers and interrupted runs never see a partial file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        yield f
+    os.replace(tmp_path, path)
+
+
+def save_results(results: np.ndarray, path: str) -> None:
+    if _is_parquet(path):
+        import pandas as pd
+        pd.DataFrame(results).to_parquet(path, index=False)
+    else:
+        with atomic_write(path) as f:
+            np.save(f, results)
+
+
+def load_results(path: str, columns: Optional[List[str]] = None, mmap: bool = True) -> np.ndarray:
+    if _is_parquet(path):
+        import pandas as pd
+        frame = pd.read_parquet(path, columns=columns)
+        return frame.to_records(index=False).view(np.ndarray)
+
+    results = np.load(path, mmap_mode='r' if mmap else None)
+    if columns is not None:
+        # A multi-field index of the memory map is a view, not a copy
+        results = results[list(columns)]
+    return results
+
+
+def export_csv(results: np.ndarray, output_file: str) -> None:
+    with open(output_file, 'w') as f:
+        f.write(', '.join(results.dtype.names) + '\n')
+        for row in results.tolist():
+            f.write(', '.join(str(value) for value in row) + '\n')
@@ -1,16 +1,19 @@
 """
-1. Place the OSZICAR and CONTCAR files in the same directory as the script.
-2. Adjust the `directory` variable in the script to specify the path to the directory containing the files.
-3. Run the script using the command:
+1. Place the OSZICAR and CONTCAR files in the same directory as the script, or pass their directory on the command line.
+2. Run the script using the command:
+
+    python simulation_analysis.py [directory ...] [--workers N] [--no-plot]
+
+   or call `analyze_directory(directory, workers)` from Python to get the results as a NumPy structured array.
 
-    python simulation_analysis.py
-    
 
 ## Output
 
 The script will generate the following output:
 
-- `output.txt`: This file contains the calculated properties for each simulation in CSV format, including file number, total energy, number of atoms, total volume, per-atom energy, per-atom volume, total magnetic moment, and per-atom magnetic moment.
+- `sim_results.npy`: The same results as a NumPy structured array, which `results_store.load_results` can memory-map to read single columns of large result sets.
+
+- `sim_results.txt`: This file contains the calculated properties for each simulation in CSV format, including file number, total energy, number of atoms, total volume, per-atom energy, per-atom volume, total magnetic moment, and per-atom magnetic moment.
 
 - scatter polt `{folder_name}.pdf`: This plot shows the relationship between per-atom volume and per-atom energy.
 
@@ -18,98 +21,242 @@ The script will generate the following output:
 
 ## Customization
 
-You can customize the behavior of the script by modifying the following variables:
+You can customize the behavior of the script with the following options:
+
+- `directory`: Specify the directory path where the OSZICAR and CONTCAR files are located. Several directories can be given; the outputs of each are written into it, and their plots are rendered in parallel.
+
+- `--output`: Specify the name of the CSV output file, or skip it with `--no-csv`.
+
+- `--store`: Specify the binary results store (`.npy`, or `.parquet` when pandas and pyarrow are available).
 
-- `directory`: Specify the directory path where the OSZICAR and CONTCAR files are located.
+- `--workers`: Number of worker processes used to parse the runs and render the plots (default: all cores).
+
+- `--no-plot`: Skip the plots. matplotlib is then never imported. Plots are rendered with the Agg backend when no display is available.
+
+- `--profile [TRACE]`: Print the time, file count and bytes read of every stage (parsing, caching, export, plotting), the utilization of the worker pool and the peak memory. With a `TRACE` file name the events are also written there as JSON. Setting the `VASP_PROFILE` environment variable has the same effect.
+
+- `--no-cache` / `--rebuild-cache`: Parsed runs are cached in `.sim_results_cache.npz` next to the files, keyed by file size and modification time, so re-running after more jobs finish only parses the new or overwritten runs. These options bypass or rebuild the cache.
 
-- `output_file`: Specify the name of the output file.
 
-    
 """
 
+import argparse
+import functools
 import os
+import sys
+from typing import List, Optional, Tuple
 import numpy as np
-import matplotlib.pyplot as plt
-
-# Specify the directory containing the OSZICAR and CONTCAR files
-directory = './'
-current_directory = os.getcwd()
-folder_name = os.path.basename(current_directory)
-
-oszicar_files = [filename for filename in os.listdir(directory) if filename.startswith('OSZICAR')]
-
-# Sort the OSZICAR files based on the numerical part after the underscore
-oszicar_files.sort(key=lambda x: int(x.split('_')[1]))
-
-# Create the output file and write the header
-output_file = 'sim_results.txt'
-with open(output_file, 'w') as f:
-    f.write('File_number, totalE, Natoms, totalV, PeratomE, PeratomV, totalMag, PeratomMag\n')
-
-    # Process each OSZICAR file
-    for oszicar_file in oszicar_files:
-        file_number = oszicar_file.split('_')[1]
-        oszicar_path = os.path.join(directory, oszicar_file)
-        contcar_path = os.path.join(directory, f'CONTCAR_{file_number}')
-
-        # Parse E0 value from OSZICAR file
-        with open(oszicar_path, 'r') as oszicar:
-            for line in oszicar:
-                if "E0=" in line:
-                    e0_value = line.split("E0=")[1].split()[0]
-                    totalE = float(e0_value)
-                    break
-
-        # Parse magnetic moment from OSZICAR file
-        with open(oszicar_path, 'r') as oszicar:
-            for line in oszicar:
-                if "mag=" in line:
-                    mag_value = line.split("mag=")[1].split()[0]
-                    totalMag = float(mag_value)
-                    break
-
-        # Parse number of atoms and volume from CONTCAR file
-        with open(contcar_path, 'r') as contcar:
-            lines = contcar.readlines()
-            number_of_atoms = int(lines[6].strip())
-            scaling_factor = float(lines[1].strip())
-            x1, x2, x3 = map(float, lines[2].split())
-            y1, y2, y3 = map(float, lines[3].split())
-            z1, z2, z3 = map(float, lines[4].split())
-            volume = np.sqrt(x1 ** 2 + x2 ** 2 + x3 ** 2) * np.sqrt(y1 ** 2 + y2 ** 2 + y3 ** 2) * np.sqrt(z1 ** 2 + z2 ** 2 + z3 ** 2)
-
-        # Calculate per-atom values
-        peratomE = totalE / number_of_atoms
-        peratomV = volume / number_of_atoms
-        peratomMag = totalMag / number_of_atoms
-
-        # Write the values to the output file
-        f.write(f'{file_number}, {totalE}, {number_of_atoms}, {volume}, {peratomE}, {peratomV}, {totalMag}, {peratomMag}\n')
-
-    # Read the output file
-    data = np.genfromtxt(output_file, delimiter=',', skip_header=1)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from poscar_module import read_poscar
+from profile_module import add_counts, add_profile_argument, map_batches, report, stage, timed
+from replicate import cell_geometry
+from results_store import atomic_write, export_csv, save_results
+
+CACHE_FILE = '.sim_results_cache.npz'
+
+# The field names, in order, are the header line of sim_results.txt written by export_csv
+RESULT_DTYPE = np.dtype([('File_number', np.int64), ('totalE', np.float64), ('Natoms', np.int64),
+                         ('totalV', np.float64), ('PeratomE', np.float64), ('PeratomV', np.float64),
+                         ('totalMag', np.float64), ('PeratomMag', np.float64)])
+
+
+def find_runs(directory: str) -> List[int]:
+    # File numbers of every OSZICAR_n in the directory, in numerical order
+    numbers = []
+    for filename in os.listdir(directory):
+        prefix, _, number = filename.partition('_')
+        if prefix == 'OSZICAR' and number.isdigit():
+            numbers.append(int(number))
+    return sorted(numbers)
+
+
+def parse_oszicar(oszicar_path: str) -> Tuple[float, float]:
+    # First E0 and magnetic moment values, read in a single pass
+    totalE = np.nan
+    totalMag = np.nan
+    with open(oszicar_path, 'r') as oszicar:
+        for line in oszicar:
+            if np.isnan(totalE) and "E0=" in line:
+                totalE = float(line.split("E0=")[1].split()[0])
+            if np.isnan(totalMag) and "mag=" in line:
+                totalMag = float(line.split("mag=")[1].split()[0])
+            if not (np.isnan(totalE) or np.isnan(totalMag)):
+                break
+    return totalE, totalMag
+
+
+def parse_run(directory: str, file_number: int) -> tuple:
+    oszicar_path = os.path.join(directory, f'OSZICAR_{file_number}')
+    contcar_path = os.path.join(directory, f'CONTCAR_{file_number}')
+    with stage('parse_run') as timer:
+        totalE, totalMag = parse_oszicar(oszicar_path)
+
+        # Parse number of atoms and the scaled lattice vectors from CONTCAR file
+        contcar = read_poscar(contcar_path)
+        if timer:
+            timer.add(files=2, bytes_read=os.path.getsize(oszicar_path) + os.path.getsize(contcar_path))
+    return file_number, totalE, contcar.natoms, contcar.vects, totalMag
+
+
+def _parse_runs(directory: str, file_numbers: List[int]) -> List[tuple]:
+    return [parse_run(directory, file_number) for file_number in file_numbers]
+
+
+def _analyze_runs(directory: str, file_numbers: List[int], workers: Optional[int]) -> np.ndarray:
+    batches = map_batches(functools.partial(_parse_runs, directory), file_numbers, workers=workers,
+                          name='parse_runs.pool')
+    rows = [row for batch in batches for row in batch]
+
+    results = np.zeros(len(rows), dtype=RESULT_DTYPE)
+    if not rows:
+        return results
+    numbers, energies, natoms, vects, mags = zip(*rows)
+    results['File_number'] = numbers
+    results['totalE'] = energies
+    results['Natoms'] = natoms
+    results['totalMag'] = mags
+
+    # Volumes of all cells in one vectorized call (determinant, valid for any cell shape)
+    results['totalV'] = cell_geometry(np.array(vects))[0]
+
+    # Calculate per-atom values
+    results['PeratomE'] = results['totalE'] / results['Natoms']
+    results['PeratomV'] = results['totalV'] / results['Natoms']
+    results['PeratomMag'] = results['totalMag'] / results['Natoms']
+    return results
+
+
+def _fingerprints(directory: str, file_numbers: List[int]) -> np.ndarray:
+    # Size and modification time of the OSZICAR and CONTCAR of every run
+    fingerprints = np.empty((len(file_numbers), 4), dtype=np.int64)
+    for i, file_number in enumerate(file_numbers):
+        oszicar = os.stat(os.path.join(directory, f'OSZICAR_{file_number}'))
+        contcar = os.stat(os.path.join(directory, f'CONTCAR_{file_number}'))
+        fingerprints[i] = (oszicar.st_size, oszicar.st_mtime_ns, contcar.st_size, contcar.st_mtime_ns)
+    return fingerprints
+
+
+def _load_cache(cache_path: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    try:
+        with np.load(cache_path) as cache:
+            results, fingerprints = cache['results'], cache['fingerprints']
+    except (OSError, KeyError, ValueError):
+        return None
+    if results.dtype != RESULT_DTYPE or fingerprints.shape != (len(results), 4):
+        return None
+    return results, fingerprints
+
+
+def _save_cache(cache_path: str, results: np.ndarray, fingerprints: np.ndarray) -> None:
+    with atomic_write(cache_path) as f:
+        np.savez(f, results=results, fingerprints=fingerprints)
+
+
+@timed('analyze_directory')
+def analyze_directory(directory: str = './', workers: Optional[int] = None,
+                      file_numbers: Optional[List[int]] = None, use_cache: bool = True,
+                      rebuild_cache: bool = False, cache_file: Optional[str] = None) -> np.ndarray:
+    """Parse every OSZICAR_n/CONTCAR_n pair into a structured array with RESULT_DTYPE fields.
+
+    Results are cached next to the runs, keyed by file number, size and
+    modification time, so only new or overwritten runs are parsed again.
+    """
+    if file_numbers is None:
+        file_numbers = find_runs(directory)
+    add_counts(runs=len(file_numbers))
+    if not use_cache:
+        return _analyze_runs(directory, file_numbers, workers)
+
+    cache_path = cache_file or os.path.join(directory, CACHE_FILE)
+    numbers = np.array(file_numbers, dtype=np.int64)
+    fingerprints = _fingerprints(directory, file_numbers)
+    cached = None if rebuild_cache else _load_cache(cache_path)
+
+    results = np.zeros(len(numbers), dtype=RESULT_DTYPE)
+    stale = np.ones(len(numbers), dtype=bool)
+    if cached is not None and len(cached[0]):
+        cached_results, cached_fingerprints = cached
+        order = np.argsort(cached_results['File_number'])
+        index = order[np.minimum(np.searchsorted(cached_results['File_number'], numbers, sorter=order),
+                                 len(order) - 1)]
+        stale = ((cached_results['File_number'][index] != numbers)
+                 | (cached_fingerprints[index] != fingerprints).any(axis=1))
+        results[~stale] = cached_results[index[~stale]]
+
+    add_counts(cached=int((~stale).sum()))
+    if stale.any():
+        results[stale] = _analyze_runs(directory, numbers[stale].tolist(), workers)
+    if cached is None or stale.any() or len(cached[0]) != len(results):
+        _save_cache(cache_path, results, fingerprints)
+    return results
+
+
+@timed('plot')
+def plot_results(results: np.ndarray, folder_name: str, directory: str = './') -> None:
+    # matplotlib is only imported when plots are requested
+    from plot_module import plot_function, save_figure
 
     # Extract per-atom volume and energy values
-    peratomV = data[:, 5]
-    peratomE = data[:, 4]
+    peratomV = results['PeratomV']
+    peratomE = results['PeratomE']
 
     # Plot peratomV vs peratomE
-    plt.scatter(peratomV, peratomE)
-    plt.xlabel('vol/atom (angstrom^3)')
-    plt.ylabel('Energy per atom (eV/atom)')
-    plt.savefig(f'{folder_name}.pdf', format='pdf')
-    plt.show()
+    fig, ax = plot_function()
+    ax.scatter(peratomV, peratomE)
+    ax.set_xlabel('vol/atom (angstrom^3)')
+    ax.set_ylabel('Energy per atom (eV/atom)')
+    save_figure(fig, os.path.join(directory, f'{folder_name}.pdf'))
 
     # Calculate ranges and counts
     energy_ranges = np.arange(np.min(peratomE), np.max(peratomE) + 1, 1)
     counts = np.histogram(peratomE, bins=energy_ranges)[0]
 
     # Plot ranges vs counts
-    plt.bar(energy_ranges[:-1], counts, width=1, align='edge')
-    plt.xlabel('Energy per atom (eV/atom)')
-    plt.ylabel('Count')
-    plt.savefig(f'{folder_name}_ranges_vs_counts.pdf', format='pdf')
-    plt.show()
+    fig, ax = plot_function()
+    ax.bar(energy_ranges[:-1], counts, width=1, align='edge')
+    ax.set_xlabel('Energy per atom (eV/atom)')
+    ax.set_ylabel('Count')
+    save_figure(fig, os.path.join(directory, f'{folder_name}_ranges_vs_counts.pdf'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collect energies, volumes and moments of VASP runs')
+    parser.add_argument('directories', nargs='*', default=['./'],
+                        help='directories containing the OSZICAR_n and CONTCAR_n files')
+    parser.add_argument('-o', '--output', default='sim_results.txt', help='CSV output file name')
+    parser.add_argument('--no-csv', action='store_true', help='skip the CSV export')
+    parser.add_argument('--store', default='sim_results.npy',
+                        help='binary results store (.npy, or .parquet with pandas)')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--no-cache', action='store_true', help=f'parse every run and ignore {CACHE_FILE}')
+    parser.add_argument('--rebuild-cache', action='store_true', help=f'parse every run and rewrite {CACHE_FILE}')
+    parser.add_argument('--no-plot', action='store_true', help='skip the plots and the matplotlib import')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
+    plot_jobs = []
+    for directory in args.directories:
+        folder_name = os.path.basename(os.path.abspath(directory))
+        results = analyze_directory(directory, workers=args.workers, use_cache=not args.no_cache,
+                                    rebuild_cache=args.rebuild_cache)
+        with stage('save_results'):
+            save_results(results, os.path.join(directory, args.store))
+        if not args.no_csv:
+            with stage('export_csv'):
+                export_csv(results, os.path.join(directory, args.output))
+        if len(results):
+            plot_jobs.append((results, folder_name, directory))
+
+        written = args.store if args.no_csv else f'{args.store} and {args.output}'
+        print(f'Data has been written to {os.path.join(directory, written)}.')
+
+    # One set of plots per run directory, rendered in parallel
+    if not args.no_plot:
+        from plot_module import render_many
+        render_many(plot_results, plot_jobs, workers=args.workers)
+    report()
 
-print(f'Data has been written to {output_file}.')
 
+if __name__ == '__main__':
+    main()